@@ -0,0 +1,108 @@
+#!/usr/local/bin/python3
+
+# street/place index for an atlas booklet: every named highway and places feature is assigned to all the
+# atlas pages and grid boxes (A-H/1-6 as labelled by layout.py) it crosses. highways are indexed per street
+# (name_group, see db/adddata.py), so that different streets of the same name get separate entries.
+# the grid boxes of all pages go into one STRtree, named features are streamed from PostGIS through a
+# server-side cursor and binned in batches (one vectorized transform + one bulk tree query per batch).
+# ./atlasindex.py data/Kunming.atlas atlas.geojson
+
+import argparse
+import configparser
+import json
+import os
+import time
+
+import numpy as np
+import psycopg2
+import shapely
+from pyproj import Transformer
+
+# returns (STRtree of all grid boxes, [ (page, column letter, row number) ] for every box, wgs bbox of all pages, wgs -> crs transformer)
+def getpageboxes(geojsonfile, crsspec, boxsize):
+  with open(geojsonfile) as f:
+    features = json.load(f)['features']
+  pages = [ feature for feature in features if feature['properties']['type'] == 'atlaspage' and feature['geometry']['type'] == 'Polygon' ]
+  # corners as written by atlaspagefeatures(): top right, bottom right, bottom left, top left
+  corners = np.array([ page['geometry']['coordinates'][0][:4] for page in pages ])
+  bbox = corners.min(axis=(0, 1)).tolist() + corners.max(axis=(0, 1)).tolist()
+
+  # (the box grid is regular in the map projection, so build the boxes there)
+  fromwgs = Transformer.from_crs('EPSG:4326', crsspec, always_xy=True)
+  corners = np.stack(fromwgs.transform(corners[..., 0], corners[..., 1]), axis=-1)
+  topleft = corners[:, 3]
+  across = corners[:, 0] - topleft
+  down = corners[:, 2] - topleft
+  nx = round(np.linalg.norm(across[0]) / boxsize)
+  ny = round(np.linalg.norm(down[0]) / boxsize)
+
+  # (page, column, row, corner, xy) -> one polygon per box
+  i = np.arange(nx).reshape(1, nx, 1, 1, 1)
+  j = np.arange(ny).reshape(1, 1, ny, 1, 1)
+  di = np.array([0, 1, 1, 0, 0]).reshape(1, 1, 1, 5, 1)
+  dj = np.array([0, 0, 1, 1, 0]).reshape(1, 1, 1, 5, 1)
+  boxcorners = topleft[:, None, None, None, :] + (i + di) / nx * across[:, None, None, None, :] + (j + dj) / ny * down[:, None, None, None, :]
+  boxes = shapely.polygons(boxcorners.reshape(-1, 5, 2))
+
+  # boxes on the left half of a double page are on the page itself, the right half is on page + 1
+  # columns are lettered from the left, rows numbered from the bottom (like the grid labels in layout.py)
+  labels = [ (page['properties']['page'] + (0 if column < nx / 2 else 1), chr(65 + column), ny - row)
+    for page in pages for column in range(nx) for row in range(ny) ]
+  return (shapely.STRtree(boxes), labels, bbox, fromwgs)
+
+# collects { (name, name_group): set of box indices } for all named highways and places intersecting the atlas
+# pages (places, and highways which haven't been grouped yet, have no name_group and are indexed by name only)
+def binfeatures(conn, tree, bbox, fromwgs, batchsize = 10000):
+  index = {}
+  cur = conn.cursor(name='atlasindex')
+  cur.itersize = batchsize
+  envelope = 'ST_MakeEnvelope(%s, %s, %s, %s, 4326)'
+  cur.execute(f"""SELECT name, name_group, ST_AsBinary(way) FROM _line WHERE highway IS NOT NULL AND name IS NOT NULL AND way && {envelope}
+    UNION ALL SELECT name, NULL, ST_AsBinary(geometry(way)) FROM places WHERE name IS NOT NULL AND geometry(way) && {envelope}""", bbox + bbox)
+  nfeatures = 0
+  while True:
+    rows = cur.fetchmany(batchsize)
+    if not rows:
+      break
+    geoms = shapely.from_wkb([ bytes(row[2]) for row in rows ])
+    geoms = shapely.transform(geoms, lambda coords: np.column_stack(fromwgs.transform(coords[:, 0], coords[:, 1])))
+    (features, boxes) = tree.query(geoms, predicate='intersects')
+    for (feature, box) in zip(features.tolist(), boxes.tolist()):
+      index.setdefault(rows[feature][:2], set()).add(box)
+    nfeatures += len(rows)
+  cur.close()
+  return (index, nfeatures)
+
+def writeindex(atlasfile, geojsonfile, box, outfile, db = 'za', user = 'za', host = 'localhost'):
+  t = time.time()
+  config = configparser.ConfigParser()
+  config.read(atlasfile)
+  (tree, labels, bbox, fromwgs) = getpageboxes(geojsonfile, config['map']['proj'], box * config.getfloat('map', 'scale') / 1000)
+  print(f'Indexing {len(labels)} grid boxes ({time.time() - t:.2f}s)')
+
+  t = time.time()
+  conn = psycopg2.connect(host=host, user=user, database=db)
+  try:
+    (index, nfeatures) = binfeatures(conn, tree, bbox, fromwgs)
+  finally:
+    conn.close()
+  print(f'{nfeatures} named features binned into {len(index)} index entries ({time.time() - t:.2f}s)')
+
+  # (streets of the same name are listed in page order)
+  entries = [ (name, sorted(set(labels[box] for box in boxes))) for ((name, group), boxes) in index.items() ]
+  with open(outfile, 'w') as f:
+    for (name, references) in sorted(entries, key=lambda entry: (entry[0].casefold(), entry[0], entry[1])):
+      f.write(name + '\t' + ', '.join(f'{page} {column}{row}' for (page, column, row) in references) + '\n')
+  print('Index written to ' + outfile)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Write a sorted street/place index (name, page and grid box) for an atlas booklet.')
+  parser.add_argument('atlas', help='atlas specification file')
+  parser.add_argument('geojson', help='atlas geojson file generated by layout.py for this atlas')
+  parser.add_argument('-box', type=float, default=27.58, help='grid box size in mm (as given to layout.py)')
+  parser.add_argument('-o', default=None, help='output filename (default: GEOJSON-index.txt)')
+  parser.add_argument('-db', default='za')
+  parser.add_argument('-dbuser', default='za')
+  parser.add_argument('-dbhost', default='localhost')
+  args = parser.parse_args()
+  writeindex(args.atlas, args.geojson, args.box, args.o or os.path.splitext(args.geojson)[0] + '-index.txt', args.db, args.dbuser, args.dbhost)
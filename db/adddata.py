@@ -1,35 +1,124 @@
 #!/usr/local/bin/python3
 
 import argparse
+import io
+import json
 import psycopg2
+import psycopg2.pool
 import os
+import subprocess
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # small cutouts:
 #./adddata.py --bbox 102.66 25.033 102.73 25.085 -- data/Kunming.osm.pbf
 #./adddata.py --bbox -96.013 36.095 -95.95 36.167 -- data/Tulsa.osm.pbf
 #./adddata.py --bbox -3.2315 55.9265 -3.1548 55.9582 -- data/Edinburgh.osm.pbf
 
+# geometry pyramid simplification algorithms: {0} is the geometry (in m), {1} the tolerance (a distance in m
+# for topology/dp, an area in m^2 for vw/chaikin, like --simplify and --simplify2)
+PYRAMIDALGORITHMS = {
+  'topology': 'ST_SimplifyPreserveTopology({0}, {1})',
+  'dp': 'ST_Simplify({0}, {1}, true)',
+  'vw': 'ST_SimplifyVW({0}, {1})',
+  'chaikin': 'ST_ChaikinSmoothing(ST_SimplifyVW({0}, {1}))' }
+
+# first SRID of the --simplifycell grid cell projections
+CELLSRID = 910000
+
+def pyramidlevel(level):
+  try:
+    (scale, tolerance, algorithm) = level.split(':')
+    if algorithm in PYRAMIDALGORITHMS:
+      return (int(scale), float(tolerance), algorithm)
+  except ValueError:
+    pass
+  raise argparse.ArgumentTypeError(f"'{level}' is not a SCALE:TOLERANCE:ALGORITHM pyramid level (algorithm one of {', '.join(PYRAMIDALGORITHMS)})")
+
 parser = argparse.ArgumentParser(description='Add (and post-process) data to an OSM PostGIS database')
 parser.add_argument('--user', default='za')
 parser.add_argument('--db', default='za')
 parser.add_argument('--style', default='za.style')
+parser.add_argument('--flex', nargs='?', const='za.lua', default=None, help='import with this osm2pgsql flex output profile instead of --style (default: za.lua), which already computes area, simplified (lines only), direction and the layer/oneway/bridge/tunnel cleanup while inserting (use for fresh imports and all subsequent appends)')
 parser.add_argument('--simplify', type=float, default=4.0)
 parser.add_argument('--simplify2', type=float, default=3000.0, help='simplification tolerance for the simplified2 column (VW)') # was already up to 5000, only small changes there
-parser.add_argument('--bbox', nargs='*', help='bounding box in "minlon minlat maxlon maxlat" (WSEN) order (provide four bbox arguments for every osmfile)')
+parser.add_argument('--simplifycell', nargs='?', type=float, const=1.0, default=None, metavar='DEGREES', help='simplify in one stereographic projection per grid cell of this size (default: 1 degree) instead of one centred on every single geometry: the cell projections are registered in spatial_ref_sys, so PostGIS sets each one up only once instead of once per row (needs INSERT/UPDATE privileges on spatial_ref_sys, see createdb.sh)')
+parser.add_argument('--bbox', nargs='*', help='bounding box in "minlon minlat maxlon maxlat" (WSEN) order (provide four bbox arguments for every osmfile): the files are clipped in parallel (--jobs) with osmium, merged and imported in one go')
 parser.add_argument('--minarea', type=int, default=16, help='polygons with an area < this will be dropped')
+parser.add_argument('--namegap', type=float, default=25.0, help='same-named highways closer than this (in m) are considered part of the same street (e.g. split carriageways)')
+parser.add_argument('--rebuild', default=False, action='store_true', help='compute the length, area and simplified columns by rewriting _line and _polygon into new (unindexed) tables that replace the old ones, instead of UPDATEing every row in place (much faster when populating a database for the first time)')
+parser.add_argument('--pyramid', nargs='*', type=pyramidlevel, metavar='SCALE:TOLERANCE:ALGORITHM', help='(re)define the levels of the geometry pyramid (_line_pyramid and _polygon_pyramid), e.g. 25000:4:topology 100000:20:dp 280000:3000:chaikin: every line and polygon is simplified once per level, for maps at that scale and smaller. once defined, later imports extend the pyramid by the new rows (no levels: remove the pyramid levels)')
+parser.add_argument('--engine', choices=['sql', 'python'], default='sql', help='compute the length and area columns in UPDATEs (sql), or stream the rows out as WKB in batches and compute them with shapely/pyproj in --processes worker processes, then COPY them back (python, see geometryengine.py; not together with --rebuild)')
+parser.add_argument('--jobs', type=int, default=1, help='split the big post-processing steps into this many osm_id-range partitions and run them in parallel (one database connection each), also the number of --bbox extracts clipped in parallel')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of parallel osm2pgsql processes (osm2pgsql --number-processes), also the number of --engine python worker processes')
+parser.add_argument('--cache', type=int, default=800, help='osm2pgsql node cache size in MB (osm2pgsql --cache)')
 parser.add_argument('osmfile', nargs='*')
 
 args = parser.parse_args()
+if args.rebuild and args.engine != 'sql':
+  parser.error('--rebuild computes the length and area columns while copying the rows, so only with --engine sql')
 
+pool = None
 try:
   conn = psycopg2.connect(host="localhost", user=args.user, database=args.db)
   cur = conn.cursor()
+  pool = psycopg2.pool.ThreadedConnectionPool(1, args.jobs, host="localhost", user=args.user, database=args.db) if args.jobs > 1 else None
+
+  # split the osm_id range of a table into (at most) args.jobs partitions of roughly equal row count
+  def getpartitions(table):
+    fractions = ','.join(str(i / args.jobs) for i in range(1, args.jobs))
+    cur.execute(f"SELECT percentile_disc(ARRAY[{fractions}]::float8[]) WITHIN GROUP (ORDER BY osm_id) FROM {table}")
+    bounds = sorted(set(bound for bound in cur.fetchone()[0] or [] if bound != None))
+    if len(bounds) == 0:
+      return [lambda column: 'TRUE']
+    return [lambda column, hi=bounds[0]: f"{column} < {hi}"] + [lambda column, lo=lo, hi=hi: f"({column} >= {lo} AND {column} < {hi})" for (lo, hi) in zip(bounds, bounds[1:])] + [lambda column, lo=bounds[-1]: f"{column} >= {lo}"]
+
+  def executepartition(snapshot, i, inpartition, cmd):
+    pconn = pool.getconn()
+    try:
+      pcur = pconn.cursor()
+      t = time.time()
+      pcur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+      pcur.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+      pcur.execute(cmd(inpartition))
+      rowcount = pcur.rowcount
+      pconn.commit()
+      print(f"  partition {i} ({inpartition('osm_id')}): {rowcount} rows affected in {time.time() - t}s")
+      return rowcount
+    except:
+      pconn.rollback()
+      print(f"  partition {i} ({inpartition('osm_id')}) failed and was rolled back")
+      raise
+    finally:
+      pool.putconn(pconn)
 
-  def execute(text, cmd, commit = False):
+  # cmd is either a plain SQL string or a function which takes an 'inpartition' function that
+  # returns the SQL condition restricting a given osm_id column to the current partition, e.g.
+  #   lambda inpartition: f"UPDATE _line SET ... WHERE {inpartition('osm_id')} AND ..."
+  # with --jobs > 1 and a partition table given, cmd is run once per osm_id-range partition of
+  # that table, in parallel. all partitions share one exported snapshot, so that every partition
+  # sees exactly the same table contents that a single serial statement would see.
+  # every partition commits on its own, so when one fails the others stay applied. partitioned steps therefore
+  # only ever touch rows that still need them (length IS NULL, isnew(), flatcap changes, ...), and a failed run
+  # is simply re-run (with the same arguments): steps that were already applied to a row don't match it again
+  def execute(text, cmd, commit = False, partition = None):
     print(text)
+    if partition != None and pool != None:
+      t = time.time()
+      # make previous steps visible to the other connections
+      conn.commit()
+      cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+      partitions = getpartitions(partition)
+      cur.execute("SELECT pg_export_snapshot()")
+      snapshot = cur.fetchone()[0]
+      with ThreadPoolExecutor(len(partitions)) as executor:
+        rowcount = sum(executor.map(lambda p: executepartition(snapshot, p[0], p[1], cmd), enumerate(partitions)))
+      conn.commit()
+      print(f"{rowcount} rows affected in {time.time() - t}s ({len(partitions)} partitions)\n")
+      return rowcount
     t = time.time()
-    cur.execute(cmd)
+    cur.execute(cmd(lambda column: 'TRUE') if callable(cmd) else cmd)
     print(f"{cur.rowcount} rows affected in {time.time() - t}s\n")
     if commit:
       t = time.time()
@@ -41,25 +130,116 @@ try:
     cur.execute(f"SELECT COUNT(*) FROM {query};")
     return str(cur.fetchone()[0]) if asstr else cur.fetchone()[0]
 
+  def gettablesize(table):
+    cur.execute(f"SELECT pg_size_pretty(pg_total_relation_size('{table}'))")
+    return cur.fetchone()[0]
+
+  # rewrite a whole table instead of UPDATEing (most of) its rows in place, which would leave a dead tuple
+  # behind for every row and update all indexes row by row: the rows, with the computed columns filled in
+  # (a dict of column -> SQL expression over the original row), are bulk-inserted into a copy
+  # without any indexes (in parallel partitions with --jobs), which then replaces the original table. its
+  # indexes (in parallel with --jobs) and dependent views are recreated once at the end
+  def rebuild(table, computed, where = 'TRUE'):
+    print(f"Rebuilding {table} ({gettablesize(table)}) to compute {', '.join(computed)}")
+    t = time.time()
+    cur.execute(f"SELECT attname FROM pg_attribute WHERE attrelid = '{table}'::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum")
+    columns = ', '.join(computed[column] + f' AS "{column}"' if column in computed else f'"{column}"' for (column,) in cur.fetchall())
+    cur.execute(f"SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = '{table}'")
+    indexes = [ indexdef for (indexdef,) in cur.fetchall() ]
+    cur.execute(f"""SELECT DISTINCT view.oid::regclass::text, pg_get_viewdef(view.oid), (SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) FROM pg_attribute WHERE attrelid = view.oid AND attnum > 0)
+      FROM pg_depend JOIN pg_rewrite ON pg_rewrite.oid = pg_depend.objid JOIN pg_class view ON view.oid = pg_rewrite.ev_class
+      WHERE pg_depend.refobjid = '{table}'::regclass AND view.oid != '{table}'::regclass""")
+    views = cur.fetchall()
+
+    # (created logged right away: an unlogged copy would have to be written to the WAL as a whole again when it is
+    # SET LOGGED at the end, a logged one only writes every row to the table and to the WAL once while copying)
+    execute(f"Creating copy of {table}...",
+      f"DROP TABLE IF EXISTS {table}_rebuild; CREATE TABLE {table}_rebuild (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+    execute(f"Copying {getcount(table)} rows into it...",
+      lambda inpartition: f"INSERT INTO {table}_rebuild SELECT * FROM (SELECT {columns} FROM {table} WHERE {inpartition('osm_id')}) computed WHERE {where}", partition=table)
+    execute(f"Replacing {table} with its rebuilt copy (and dropping {len(views)} dependent views)...",
+      f"DROP TABLE {table} CASCADE; ALTER TABLE {table}_rebuild RENAME TO {table};", commit=True)
+
+    print(f"Recreating {len(indexes)} indexes on {table}...")
+    ti = time.time()
+    def createindex(indexdef):
+      iconn = pool.getconn() if pool != None else conn
+      try:
+        icur = iconn.cursor()
+        icur.execute(indexdef)
+        iconn.commit()
+      finally:
+        if pool != None:
+          pool.putconn(iconn)
+    with ThreadPoolExecutor(args.jobs) as executor:
+      list(executor.map(createindex, indexes))
+    print(f"Indexes took {time.time() - ti}s\n")
+    for (view, definition, viewcolumns) in views:
+      execute(f"Recreating view {view}", f"CREATE VIEW {view} ({viewcolumns}) AS {definition}")
+    execute(f"Analyzing {table}", f"ANALYZE {table}", commit=True)
+    print(f"Rebuilt {table} in {time.time() - t}s, now {gettablesize(table)}\n")
+
   cur.execute("SELECT 1 FROM information_schema.tables WHERE table_name = '_point'")
   append = '' if cur.fetchone() == None else '--append'
 
-  cmd = f"osm2pgsql -U {args.user} --database {args.db} --prefix '' --slim --latlong --style {args.style} --multi-geometry {append} "
+  if args.flex:
+    # (the flex profile simplifies while importing, so tell it the tolerance)
+    os.environ['ZA_SIMPLIFY'] = str(args.simplify)
+    cmd = f"osm2pgsql -U {args.user} --database {args.db} --prefix '' --slim --output flex --style {args.flex} --number-processes {args.processes} --cache {args.cache} {append} "
+  else:
+    cmd = f"osm2pgsql -U {args.user} --database {args.db} --prefix '' --slim --latlong --style {args.style} --multi-geometry --number-processes {args.processes} --cache {args.cache} {append} "
   # --append can only be used with slim mode (so don't --drop!)
 
+  # (nodes, ways, relations) in an osm file
+  def getobjectcounts(file):
+    info = json.loads(subprocess.run(['osmium', 'fileinfo', '--extended', '--json', file], capture_output=True, text=True, check=True).stdout)
+    return (info['data']['count']['nodes'], info['data']['count']['ways'], info['data']['count']['relations'])
+
+  def throughput(counts, seconds):
+    return f"{counts[0]} nodes, {counts[1]} ways, {counts[2]} relations in {seconds:.1f}s ({counts[0] / seconds:.0f} nodes/s, {counts[1] / seconds:.0f} ways/s)"
+
+  def osm2pgsql(files):
+    t = time.time()
+    if os.system(cmd + '"' + '" "'.join(files) + '"') != 0:
+      print(cmd)
+      raise Exception('osm2pgsql failed!')
+    return time.time() - t
+
   if args.bbox == None:
     if len(args.osmfile) > 0:
       # add all at once
-      if os.system(cmd + '"' + '" "'.join(args.osmfile) + '"') != 0:
-        print(cmd)
-        raise Exception('osm2pgsql failed!')
+      osm2pgsql(args.osmfile)
   else:
-    # add each individually
+    # clip all extracts in parallel, merge them (which also drops the duplicates of overlapping extracts)
+    # and import everything with a single osm2pgsql run, instead of one --bbox import after the other
     bboxes = [','.join(map(str, args.bbox[i:i + 4])) for i in range(0, len(args.bbox), 4)]
-    for (file, bbox) in zip(args.osmfile, bboxes):
-      print(f"Adding {file} ({bbox})")
-      if os.system(cmd + f'--bbox "{bbox}" {file}') != 0:
-        raise Exception('osm2pgsql failed!')
+    with tempfile.TemporaryDirectory(prefix='adddata-') as tmpdir:
+      def clip(i, file, bbox):
+        t = time.time()
+        clipped = os.path.join(tmpdir, f'{i}.osm.pbf')
+        subprocess.run(['osmium', 'extract', '--bbox', bbox, '--strategy', 'complete_ways', '--overwrite', '-o', clipped, file], check=True)
+        seconds = time.time() - t
+        print(f"Clipped {file} to {bbox}: {throughput(getobjectcounts(clipped), seconds)}")
+        return clipped
+
+      print(f"Clipping {len(bboxes)} extracts ({args.jobs} in parallel)...")
+      t = time.time()
+      with ThreadPoolExecutor(args.jobs) as executor:
+        clipped = list(executor.map(clip, range(len(bboxes)), args.osmfile, bboxes))
+      print(f"Clipping took {time.time() - t:.1f}s\n")
+
+      if len(clipped) > 1:
+        print(f"Merging {len(clipped)} extracts...")
+        t = time.time()
+        merged = os.path.join(tmpdir, 'merged.osm.pbf')
+        subprocess.run(['osmium', 'merge', '--overwrite', '-o', merged] + clipped, check=True)
+        print(f"Merged {throughput(getobjectcounts(merged), time.time() - t)}\n")
+      else:
+        merged = clipped[0]
+
+      counts = getobjectcounts(merged)
+      print(f"Importing {merged} ({args.processes} processes, {args.cache}MB cache)...")
+      print(f"Imported {throughput(counts, osm2pgsql([merged]))}\n")
 
   cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = '_polygon' AND column_name = 'area'")
   schema = cur.fetchone()
@@ -78,6 +258,32 @@ try:
       CREATE INDEX _line_simplified_idx ON _line USING GIST(simplified);""")
     conn.commit()
 
+  # rows which osm2pgsql added (or re-added when updating an object with --append) since the last
+  # run don't have an import generation yet, so post-processing only has to look at those rows and
+  # their neighbours. (to re-process everything, SET generation = NULL on all three tables)
+  cur.execute("""ALTER TABLE _point ADD COLUMN IF NOT EXISTS generation INTEGER;
+    ALTER TABLE _line ADD COLUMN IF NOT EXISTS generation INTEGER;
+    ALTER TABLE _polygon ADD COLUMN IF NOT EXISTS generation INTEGER;
+    CREATE INDEX IF NOT EXISTS _point_new_idx ON _point (osm_id) WHERE generation IS NULL;
+    CREATE INDEX IF NOT EXISTS _line_new_idx ON _line (osm_id) WHERE generation IS NULL;
+    CREATE INDEX IF NOT EXISTS _polygon_new_idx ON _polygon (osm_id) WHERE generation IS NULL;
+    ALTER TABLE _line ADD COLUMN IF NOT EXISTS name_group BIGINT;
+    ALTER TABLE _line ADD COLUMN IF NOT EXISTS name_groupsize INTEGER;
+    ALTER TABLE _line ALTER COLUMN flatcap SET DEFAULT false;""")
+  conn.commit()
+  cur.execute("SELECT COALESCE(GREATEST((SELECT MAX(generation) FROM _point), (SELECT MAX(generation) FROM _line), (SELECT MAX(generation) FROM _polygon)), 0) + 1")
+  generation = cur.fetchone()[0]
+  print(f"Post-processing import generation {generation}: {getcount('_point WHERE generation IS NULL')} new points, {getcount('_line WHERE generation IS NULL')} new lines, {getcount('_polygon WHERE generation IS NULL')} new polygons\n")
+
+  def isnew(table):
+    return f"{table}.generation IS NULL"
+
+  # lines which are new or share a node with a new highway or one that was deleted or changed by this import
+  # (i.e. whose connectivity might have changed, see _line_node_removed below)
+  def touchesnew(table):
+    return f"""({isnew(table)} OR {table}.osm_id IN (SELECT existing.osm_id FROM _line_node added JOIN _line_node existing ON existing.x = added.x AND existing.y = added.y WHERE {isnew('added')} AND existing.generation IS NOT NULL)
+      OR {table}.osm_id IN (SELECT existing.osm_id FROM _line_node_removed removed JOIN _line_node existing ON existing.x = removed.x AND existing.y = removed.y WHERE existing.generation IS NOT NULL))"""
+
   # OSM urban places: city > borough   >   suburb > quarter   >   neighbourhood > city_block > plot, square
   # OSM rural places:    town   >   village       >       hamlet                >              isolated_dwelling, farm, allotments 
   # OSM other places: island > islet, square, locality
@@ -87,81 +293,228 @@ try:
   # POSTPROCESSING
   execute("Removing inner rings from leisure = 'golf_course' polygons...",
     # TODO this won't work on MultiPolygons...
-    "UPDATE _polygon SET way = ST_MakePolygon(ST_ExteriorRing(way)) WHERE leisure = 'golf_course' AND ST_GeometryType(way) = 'ST_Polygon' AND ST_NumInteriorRings(way) > 0;")
+    f"UPDATE _polygon SET way = ST_MakePolygon(ST_ExteriorRing(way)), simplified = NULL WHERE {isnew('_polygon')} AND leisure = 'golf_course' AND ST_GeometryType(way) = 'ST_Polygon' AND ST_NumInteriorRings(way) > 0;")
+
+  proj = "'+proj=stere +lat_0=' || ST_Y(ST_Centroid(way)) || ' +lon_0=' || ST_X(ST_Centroid(way)) || ' +k=1 +datum=WGS84 +units=m +no_defs'"
+  #proj = "'+proj=gnom +lat_0=' || ST_Y(ST_Centroid(way)) || ' +lon_0=' || ST_X(ST_Centroid(way)) || ' +datum=WGS84 +units=m +no_defs'"
+  # simplification is done in a local projection (in m): simplify is a function which takes the projected way
+  # and returns the SQL expression that simplifies it, inlocal returns the expression transformed back to 4326
+  def inlocal(simplify):
+    return f"ST_Transform({simplify(f'ST_Transform(way, {proj})')}, {proj}, 4326)"
 
-  execute(f"Populating length column ({getcount('_line WHERE length IS NULL')} rows)...",
-    'UPDATE _line SET length = ST_Length(way, false) WHERE length IS NULL')
+  # with proj4 strings PostGIS has to parse and set up a new projection for every row, but it caches the ones of
+  # known SRIDs: so register one stereographic projection per --simplifycell grid cell (centred on the cell) in
+  # spatial_ref_sys, and transform every geometry with the one of the cell that its centroid falls into
+  if args.simplifycell:
+    cur.execute("SELECT has_table_privilege('spatial_ref_sys', 'INSERT, UPDATE')")
+    if not cur.fetchone()[0]:
+      print(f"--simplifycell needs INSERT and UPDATE privileges on spatial_ref_sys (GRANT INSERT, UPDATE ON spatial_ref_sys TO {args.user}), using per-geometry projections\n")
+    else:
+      (xcells, ycells) = (round(180 / args.simplifycell), round(90 / args.simplifycell))
+      # (user SRIDs end at 998999)
+      if (2 * xcells + 1) * (2 * ycells + 1) > 998999 - CELLSRID:
+        raise ValueError(f"--simplifycell {args.simplifycell} is too small, there are only {998999 - CELLSRID} SRIDs for grid cells")
+      cellsrid = f"({CELLSRID} + (round(ST_Y(ST_Centroid(way)) / {args.simplifycell})::INTEGER + {ycells}) * {2 * xcells + 1} + round(ST_X(ST_Centroid(way)) / {args.simplifycell})::INTEGER + {xcells})"
+      execute(f"Registering stereographic projections for {(2 * xcells + 1) * (2 * ycells + 1)} grid cells of {args.simplifycell} degrees...",
+        f"""INSERT INTO spatial_ref_sys (srid, auth_name, auth_srid, proj4text)
+          SELECT {CELLSRID} + (y + {ycells}) * {2 * xcells + 1} + x + {xcells}, 'za', {CELLSRID} + (y + {ycells}) * {2 * xcells + 1} + x + {xcells},
+            '+proj=stere +lat_0=' || y * {args.simplifycell} || ' +lon_0=' || x * {args.simplifycell} || ' +k=1 +datum=WGS84 +units=m +no_defs'
+          FROM generate_series({-xcells}, {xcells}) x, generate_series({-ycells}, {ycells}) y
+          ON CONFLICT (srid) DO UPDATE SET auth_name = EXCLUDED.auth_name, auth_srid = EXCLUDED.auth_srid, proj4text = EXCLUDED.proj4text;""", commit=True)
+
+      def inlocal(simplify):
+        return f"ST_Transform({simplify(f'ST_Transform(way, {cellsrid})')}, 4326)"
+
+  simplified = inlocal(lambda local: f"ST_SimplifyPreserveTopology({local}, {args.simplify})")
+  simplified2 = inlocal(lambda local: f"ST_ChaikinSmoothing(ST_SimplifyVW({local}, {args.simplify2}))")
+  # (VW can collapse small polygons to NULL, so also only look at new rows instead of re-trying those every time)
+  needssimplified2 = f"{isnew('_polygon')} AND simplified2 IS NULL AND (aeroway IS NOT NULL OR landuse IS NOT NULL OR 'natural' IS NOT NULL OR water IS NOT NULL)"
   ## faster but fails in Serbia: https://gis.stackexchange.com/questions/312910/postgis-st-area-causing-error-when-used-with-use-spheroid-false-setting-succe
-  execute(f"Populating area column ({getcount('_polygon WHERE area IS NULL')} rows)...",
-    'UPDATE _polygon SET area = ST_Area(Geography(way)) WHERE area IS NULL')
+  area = "ST_Area(Geography(way))"
 
-  execute(f"Deleting polygons below a minimum size of {args.minarea}m^2", f"DELETE FROM _polygon WHERE area < {args.minarea}")
-  # TODO delete highway = 'footpath', 'path' ETC which are short and either (a) only connected to other short paths or (b) contained in small (garden?) polygons
+  if args.rebuild:
+    # same results as the UPDATEs below, but every row is only written (and WAL-logged) once in a bulk insert,
+    # without leaving a dead tuple behind and without any index maintenance (the indexes are rebuilt at the end)
+    rebuild('_line', {'length': 'COALESCE(length, ST_Length(way, false))', 'simplified': f"COALESCE(simplified, {simplified})"})
+    rebuild('_polygon', {'area': f"COALESCE(area, {area})", 'simplified': f"COALESCE(simplified, {simplified})", 'simplified2': f"CASE WHEN {needssimplified2} THEN {simplified2} ELSE simplified2 END"},
+      where=f"area IS NULL OR area >= {args.minarea}")
+  else:
+    if args.engine == 'python':
+      import geometryengine
+      # (rows it can't match by osm_id are left NULL, and picked up by the UPDATEs below)
+      for (table, column) in [('_line', 'length'), ('_polygon', 'area')]:
+        print(f"Computing {column} column of {getcount(f'{table} WHERE {column} IS NULL')} {table} rows in {args.processes} processes...")
+        t = time.time()
+        print(f"{geometryengine.computecolumn(conn, table, column, args.processes)} rows affected in {time.time() - t}s\n")
+    execute(f"Populating length column ({getcount('_line WHERE length IS NULL')} rows)...",
+      lambda inpartition: f"UPDATE _line SET length = ST_Length(way, false) WHERE {inpartition('osm_id')} AND length IS NULL", partition='_line')
+    execute(f"Populating area column ({getcount('_polygon WHERE area IS NULL')} rows)...",
+      lambda inpartition: f"UPDATE _polygon SET area = {area} WHERE {inpartition('osm_id')} AND area IS NULL", partition='_polygon')
 
-  proj = "'+proj=stere +lat_0=' || ST_Y(ST_Centroid(way)) || ' +lon_0=' || ST_X(ST_Centroid(way)) || ' +k=1 +datum=WGS84 +units=m +no_defs'"
-  #proj = "'+proj=gnom +lat_0=' || ST_Y(ST_Centroid(way)) || ' +lon_0=' || ST_X(ST_Centroid(way)) || ' +datum=WGS84 +units=m +no_defs'"
-  execute(f"Simplifying {getcount('_polygon WHERE simplified IS NULL')} polygons (tolerance={args.simplify}m)...",
-    f"UPDATE _polygon SET simplified = ST_Transform(ST_SimplifyPreserveTopology(ST_Transform(way, {proj}), {args.simplify}), {proj}, 4326) WHERE simplified IS NULL;")
-  execute(f"Simplifying {getcount('_polygon WHERE simplified2 IS NULL')} polygons for overview (tolerance={args.simplify2}m)...",
-    f"UPDATE _polygon SET simplified2 = ST_Transform(ST_ChaikinSmoothing(ST_SimplifyVW(ST_Transform(way, {proj}), {args.simplify2})), {proj}, 4326) WHERE (aeroway IS NOT NULL OR landuse IS NOT NULL OR 'natural' IS NOT NULL OR water IS NOT NULL);") # TODO REPLACE CONDITION AND simplified2 IS NULL;")
-#  cur.execute("UPDATE _polygon SET simplified = ST_Transform(ST_SimplifyPreserveTopology(ST_Transform(way, $PROJ), $TOLERANCE), $PROJ, 4326), simplified2 = ST_Transform(ST_SimplifyVW(ST_Transform(way, $PROJ), $TOLERANCE), $PROJ, 4326) WHERE simplified IS NULL;")
-  execute(f"Simplifying {getcount('_line WHERE simplified IS NULL')} ways (tolerance={args.simplify}m)...",
-    f"UPDATE _line SET simplified = ST_Transform(ST_SimplifyPreserveTopology(ST_Transform(way, {proj}), {args.simplify}), {proj}, 4326) WHERE simplified IS NULL;")
+    execute(f"Deleting polygons below a minimum size of {args.minarea}m^2", f"DELETE FROM _polygon WHERE area < {args.minarea}")
+
+    execute(f"Simplifying {getcount('_polygon WHERE simplified IS NULL')} polygons (tolerance={args.simplify}m)...",
+      lambda inpartition: f"UPDATE _polygon SET simplified = {simplified} WHERE {inpartition('osm_id')} AND simplified IS NULL;", partition='_polygon')
+    execute(f"Simplifying {getcount('_polygon WHERE ' + needssimplified2)} polygons for overview (tolerance={args.simplify2}m)...",
+      lambda inpartition: f"UPDATE _polygon SET simplified2 = {simplified2} WHERE {inpartition('osm_id')} AND {needssimplified2};", partition='_polygon')
+#    cur.execute("UPDATE _polygon SET simplified = ST_Transform(ST_SimplifyPreserveTopology(ST_Transform(way, $PROJ), $TOLERANCE), $PROJ, 4326), simplified2 = ST_Transform(ST_SimplifyVW(ST_Transform(way, $PROJ), $TOLERANCE), $PROJ, 4326) WHERE simplified IS NULL;")
+    execute(f"Simplifying {getcount('_line WHERE simplified IS NULL')} ways (tolerance={args.simplify}m)...",
+      lambda inpartition: f"UPDATE _line SET simplified = {simplified} WHERE {inpartition('osm_id')} AND simplified IS NULL;", partition='_line')
+    print(f"Table sizes after updating in place: _line {gettablesize('_line')}, _polygon {gettablesize('_polygon')}\n")
+  # TODO delete highway = 'footpath', 'path' ETC which are short and either (a) only connected to other short paths or (b) contained in small (garden?) polygons
 
   execute("Removing layer = 0, tunnel = 'no', oneway = 'no', bridge = 'no' tags...",
-    """UPDATE _line SET layer = NULL WHERE layer = 0;
-    UPDATE _line SET oneway = NULL WHERE oneway = 'no';
-    UPDATE _line SET bridge = NULL WHERE bridge = 'no';
-    UPDATE _line SET tunnel = NULL WHERE tunnel = 'no';""")
+    lambda inpartition: f"""UPDATE _line SET layer = NULL WHERE {inpartition('osm_id')} AND {isnew('_line')} AND layer = 0;
+    UPDATE _line SET oneway = NULL WHERE {inpartition('osm_id')} AND {isnew('_line')} AND oneway = 'no';
+    UPDATE _line SET bridge = NULL WHERE {inpartition('osm_id')} AND {isnew('_line')} AND bridge = 'no';
+    UPDATE _line SET tunnel = NULL WHERE {inpartition('osm_id')} AND {isnew('_line')} AND tunnel = 'no';""", partition='_line')
 
   genericbuilding = "('yes', 'public', 'roof', 'service')"
   AMENITY = "('hospital', 'school', 'college', 'university', 'arts_centre', 'bus_station', 'place_of_worship')"
   LANDUSE = "('depot', 'industrial', 'railway', 'retail')" # TODO also do with 'commercial' or 'retail'?
   LEISURE = "('sports_centre')"
   #containsspatially = "ST_Covers(grounds.way, bldg.way)"
-  containsspatially = "ST_Within(ST_Centroid(bldg.way), grounds.way)"
-  execute("Marking any underspecified buildings on amenity (school, hospital,...) grounds as buildings of that type, and removing names of buildings contained in areas of the same name...",
+  containsspatially = "ST_Within(bldg.centroid, grounds.way)"
+  execute("Marking underspecified buildings with amenity, tourism or shop tags as buildings of that type...",
 #    f"""UPDATE _polygon SET building = NULL WHERE building = 'no';
-    f"""UPDATE _polygon SET building = amenity WHERE building in {genericbuilding} AND amenity IS NOT NULL;
-    UPDATE _polygon SET building = tourism WHERE building in {genericbuilding} AND tourism IS NOT NULL;
-    UPDATE _polygon SET building = 'commercial' WHERE building IN {genericbuilding} AND shop IS NOT NULL;
-    UPDATE _polygon bldg SET building = grounds.amenity FROM _polygon grounds WHERE bldg.building IN {genericbuilding} AND bldg.leisure IS NULL AND grounds.building IS NULL AND grounds.amenity IN {AMENITY} AND {containsspatially};
-    UPDATE _polygon bldg SET name = NULL FROM _polygon grounds WHERE bldg.building IS NOT NULL AND bldg.name IS NOT NULL AND grounds.building IS NULL AND bldg.name = grounds.name AND (grounds.amenity IN {AMENITY} OR grounds.landuse IS NOT NULL) AND {containsspatially};
-    UPDATE _polygon bldg SET building = grounds.landuse FROM _polygon grounds WHERE bldg.building IN {genericbuilding} AND bldg.leisure IS NULL AND grounds.building IS NULL AND grounds.landuse IN {LANDUSE} AND {containsspatially};
-    UPDATE _polygon bldg SET building = grounds.leisure FROM _polygon grounds WHERE bldg.building IN {genericbuilding} AND bldg.leisure IS NULL AND grounds.building IS NULL AND grounds.leisure IN {LEISURE} AND {containsspatially};""")
+    lambda inpartition: f"""UPDATE _polygon SET building = amenity WHERE {inpartition('osm_id')} AND {isnew('_polygon')} AND building in {genericbuilding} AND amenity IS NOT NULL;
+    UPDATE _polygon SET building = tourism WHERE {inpartition('osm_id')} AND {isnew('_polygon')} AND building in {genericbuilding} AND tourism IS NOT NULL;
+    UPDATE _polygon SET building = 'commercial' WHERE {inpartition('osm_id')} AND {isnew('_polygon')} AND building IN {genericbuilding} AND shop IS NOT NULL;""", partition='_polygon')
+
+  # the building/grounds rules below all look for buildings whose centroid lies within some grounds, so the
+  # centroids of all buildings that any rule could apply to and all grounds that any rule looks at are
+  # materialized once (unlogged, with GiST indexes), joined once into _bldg_grounds, and every rule then only
+  # joins _polygon against that (small) result by osm_id. the rules still check the current building tags,
+  # so they apply in the same order (a building which became a school is no longer on 'industrial' grounds)
+  execute("Materializing building centroids and amenity/landuse/leisure grounds...",
+    f"""DROP TABLE IF EXISTS _bldg_centroid, _grounds, _bldg_grounds;
+    CREATE UNLOGGED TABLE _bldg_centroid AS SELECT osm_id, generation, ST_Centroid(way) AS centroid FROM _polygon WHERE building IS NOT NULL AND ((building IN {genericbuilding} AND leisure IS NULL) OR name IS NOT NULL);
+    CREATE UNLOGGED TABLE _grounds AS SELECT osm_id, generation, name, amenity, landuse, leisure, way FROM _polygon WHERE building IS NULL AND (amenity IN {AMENITY} OR landuse IS NOT NULL OR leisure IN {LEISURE});
+    CREATE INDEX ON _bldg_centroid USING GIST (centroid);
+    CREATE INDEX ON _grounds USING GIST (way);
+    ANALYZE _bldg_centroid;
+    ANALYZE _grounds;
+    CREATE UNLOGGED TABLE _bldg_grounds (osm_id BIGINT, name TEXT, amenity TEXT, landuse TEXT, leisure TEXT);""", commit=True)
+  # old buildings can end up on new grounds and vice versa
+  eithernew = f"({isnew('bldg')} OR {isnew('grounds')})"
+  execute(f"Finding the grounds of {getcount('_bldg_centroid')} buildings among {getcount('_grounds')} grounds...",
+    lambda inpartition: f"INSERT INTO _bldg_grounds SELECT bldg.osm_id, grounds.name, grounds.amenity, grounds.landuse, grounds.leisure FROM _bldg_centroid bldg JOIN _grounds grounds ON {containsspatially} WHERE {inpartition('bldg.osm_id')} AND {eithernew}", partition='_bldg_centroid')
+  execute("Indexing building/grounds pairs", "CREATE INDEX ON _bldg_grounds (osm_id); ANALYZE _bldg_grounds;", commit=True)
+
+  execute("Marking underspecified buildings on amenity (school, hospital,...) grounds as buildings of that type...",
+    f"UPDATE _polygon bldg SET building = grounds.amenity FROM _bldg_grounds grounds WHERE bldg.osm_id = grounds.osm_id AND bldg.building IN {genericbuilding} AND bldg.leisure IS NULL AND grounds.amenity IN {AMENITY};")
+  execute("Removing names of buildings contained in amenity or landuse areas of the same name...",
+    f"UPDATE _polygon bldg SET name = NULL FROM _bldg_grounds grounds WHERE bldg.osm_id = grounds.osm_id AND bldg.building IS NOT NULL AND bldg.name IS NOT NULL AND bldg.name = grounds.name AND (grounds.amenity IN {AMENITY} OR grounds.landuse IS NOT NULL);")
+  execute("Marking underspecified buildings on depot, industrial, railway or retail land as buildings of that type...",
+    f"UPDATE _polygon bldg SET building = grounds.landuse FROM _bldg_grounds grounds WHERE bldg.osm_id = grounds.osm_id AND bldg.building IN {genericbuilding} AND bldg.leisure IS NULL AND grounds.landuse IN {LANDUSE};")
+  execute("Marking underspecified buildings on sports centre grounds as buildings of that type...",
+    f"UPDATE _polygon bldg SET building = grounds.leisure FROM _bldg_grounds grounds WHERE bldg.osm_id = grounds.osm_id AND bldg.building IN {genericbuilding} AND bldg.leisure IS NULL AND grounds.leisure IN {LEISURE};")
+  execute("Dropping building centroids and grounds", "DROP TABLE _bldg_centroid, _grounds, _bldg_grounds;", commit=True)
 
   # TODO set amenity-area name to amenity only if it contains no named buildings...
   #psql -d "$DBNAME" -c "UPDATE _polygon grounds SET name = amenity FROM _polygon bldg WHERE grounds.name IS NULL AND grounds.amenity IN $AMENITY AND bldg.building IS NOT NULL AND NOT ST_Covers(grounds.way, bldg.way);"
   # TODO add name = 'School' for buildings which are NOT on (named) school grounds
   #psql -d "$DBNAME" -c "UPDATE _polygon bldg SET name = amenity FROM _polygon grounds WHERE bldg.name IS NULL AND bldg.building IN $AMENITY AND bldg.building = grounds.amenity AND NOT ST_Covers(grounds.way, bldg.way);"
 
-  ncols = getcount("information_schema.columns WHERE table_name = '_polygon'", False)
-  # don't select way, area, simplified, simplified2
-  cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = '_polygon' LIMIT " + str(ncols - 4))
+  # don't select way, area, simplified, simplified2, generation (or any other column that _line doesn't have)
+  cur.execute("SELECT column_name FROM information_schema.columns p WHERE table_name = '_polygon' AND column_name NOT IN ('way', 'area', 'simplified', 'simplified2', 'generation') AND EXISTS (SELECT 1 FROM information_schema.columns l WHERE l.table_name = '_line' AND l.column_name = p.column_name) ORDER BY ordinal_position")
   cols = ", ".join(map(lambda col: '"' + col[0] + '"', cur.fetchall()))
 
+  # (only new ones, otherwise they'd be copied again on every run)
   execute("Copying roundabouts accidentally added as polygons over to _line table...",
-    f"INSERT INTO _line SELECT {cols}, ST_ExteriorRing(way) AS way FROM _polygon WHERE highway IS NOT NULL AND (oneway = 'yes' OR junction = 'roundabout')")
+    f"INSERT INTO _line ({cols}, way) SELECT {cols}, ST_ExteriorRing(way) AS way FROM _polygon WHERE {isnew('_polygon')} AND highway IS NOT NULL AND (oneway = 'yes' OR junction = 'roundabout')")
 
   execute("Populating direction column...",
-    "UPDATE _line SET direction = ('1=>1, yes=>1, -1=>-1'::hstore -> oneway)::INTEGER * CASE WHEN ST_Contains(ST_Envelope(ST_GeomFromText('LINESTRING(-12 61, 2 50)', 4326)), way) THEN -1 ELSE 1 END WHERE direction IS NULL;")
+    lambda inpartition: f"UPDATE _line SET direction = ('1=>1, yes=>1, -1=>-1'::hstore -> oneway)::INTEGER * CASE WHEN ST_Contains(ST_Envelope(ST_GeomFromText('LINESTRING(-12 61, 2 50)', 4326)), way) THEN -1 ELSE 1 END WHERE {inpartition('osm_id')} AND {isnew('_line')} AND direction IS NULL AND oneway IN ('1', 'yes', '-1');", partition='_line')
+
+  # TOPOLOGY
+  # every vertex of every highway, snapped to the 7 decimal places that OSM node coordinates have, so
+  # that ways which share an OSM node end up with identical (x, y) keys and connectivity questions
+  # become plain (hash) equi-joins instead of spatial self-joins. isstart/isend mark the first/last
+  # vertex of (non-multi) linestrings, i.e. the ends where a way can be a dead end.
+  # (could also be used for the footpath pruning TODO above: the degree of a node is just COUNT(*) GROUP BY x, y)
+  # the index of the previous run still has the vertices of highways which --append has deleted since (or
+  # re-added as new rows, possibly with different nodes): keep those, so that their former neighbours are
+  # re-tested too, and their names, so that the streets they were part of are regrouped. (if the unlogged index was
+  # lost, e.g. after a crash, deletions need a full run: SET generation = NULL on _line.) they are only cleared once
+  # the run has completed, so that a failed run which already rebuilt the index below can simply be re-run
+  cur.execute("SELECT to_regclass('_line_node') IS NOT NULL")
+  execute("Keeping the nodes of deleted and changed highways...",
+    """CREATE UNLOGGED TABLE IF NOT EXISTS _line_node_removed (x BIGINT, y BIGINT, name TEXT);
+    CREATE INDEX IF NOT EXISTS _line_node_removed_xy_idx ON _line_node_removed (x, y);""" + ("""
+    INSERT INTO _line_node_removed SELECT DISTINCT x, y, name FROM _line_node old WHERE NOT EXISTS (SELECT 1 FROM _line WHERE _line.osm_id = old.osm_id AND _line.generation IS NOT NULL);""" if cur.fetchone()[0] else "") + """
+    ANALYZE _line_node_removed;""")
+  execute("Building highway node index...",
+    """DROP TABLE IF EXISTS _line_node;
+    CREATE UNLOGGED TABLE _line_node AS SELECT osm_id, highway, name, tunnel, generation,
+        single AND (dp).path[1] = 1 AS isstart, single AND (dp).path[1] = npoints AS isend,
+        ROUND(ST_X((dp).geom) * 10000000)::BIGINT AS x, ROUND(ST_Y((dp).geom) * 10000000)::BIGINT AS y
+      FROM (SELECT osm_id, highway, name, tunnel, generation, ST_GeometryType(way) = 'ST_LineString' AS single, ST_NPoints(way) AS npoints, ST_DumpPoints(way) AS dp FROM _line WHERE highway IS NOT NULL) vertices;
+    CREATE INDEX _line_node_xy_idx ON _line_node (x, y);
+    CREATE INDEX _line_node_osm_id_idx ON _line_node (osm_id);
+    ANALYZE _line_node;""")
 
   ## compute which ways should have flat caps (because they are a dead end on at least one side)
   connectedhighways = "('motorway', 'motorway_link', 'primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary', 'residential', 'unclassified', 'road', 'pedestrian')"
-  execute(f"Populating flatcap column (testing {getcount('_line WHERE flatcap = false')} rows)...",
-    f"UPDATE _line SET flatcap = true WHERE flatcap = false AND _line.osm_id NOT IN (SELECT DISTINCT ON (source.osm_id) source.osm_id FROM _line source JOIN _line end1 ON (end1.highway IN {connectedhighways} OR source.highway = end1.highway) AND source.osm_id != end1.osm_id AND end1.tunnel IS NULL AND ST_Covers(end1.way, ST_StartPoint(source.way)) JOIN _line end2 ON (end2.highway IN {connectedhighways} OR source.highway = end2.highway) AND source.osm_id != end2.osm_id AND end2.tunnel IS NULL AND ST_Covers(end2.way, ST_EndPoint(source.way)) WHERE source.highway IS NOT NULL);")
+  # highways which have another (non-tunnel) way of a connecting type attached to both their start and end node
+  def connected(inpartition):
+    return f"""(SELECT source.osm_id FROM _line_node source JOIN _line_node other ON other.x = source.x AND other.y = source.y AND other.osm_id != source.osm_id AND other.tunnel IS NULL AND (other.highway IN {connectedhighways} OR other.highway = source.highway)
+      WHERE {inpartition('source.osm_id')} AND (source.isstart OR source.isend) GROUP BY source.osm_id HAVING bool_or(source.isstart) AND bool_or(source.isend))"""
+  # (new highways can turn the dead end of an existing way into a junction, so those are re-tested as well)
+  # only rows whose flatcap actually changes are written
+  execute(f"Populating flatcap column (testing {getcount('_line WHERE ' + touchesnew('_line'))} rows)...",
+    lambda inpartition: f"""UPDATE _line SET flatcap = true WHERE {inpartition('_line.osm_id')} AND {touchesnew('_line')} AND NOT flatcap AND NOT EXISTS (SELECT 1 FROM {connected(inpartition)} c WHERE c.osm_id = _line.osm_id);
+    UPDATE _line SET flatcap = false WHERE {inpartition('_line.osm_id')} AND {touchesnew('_line')} AND flatcap AND EXISTS (SELECT 1 FROM {connected(inpartition)} c WHERE c.osm_id = _line.osm_id);""", partition='_line')
   # QUERY to test:
-  # SELECT DISTINCT ON (source.osm_id) source.osm_id, end1.osm_id, end2.osm_id, source.flatcap FROM _line source LEFT JOIN _line end1 ON end1.highway IS NOT NULL AND source.osm_id != end1.osm_id AND ST_Covers(end1.way, ST_StartPoint(source.way)) LEFT JOIN _line end2 ON end2.highway IS NOT NULL AND source.osm_id != end2.osm_id AND ST_Covers(end2.way, ST_EndPoint(source.way)) WHERE source.highway IS NOT NULL;
+  # SELECT source.osm_id, source.isstart, other.osm_id, other.highway FROM _line_node source LEFT JOIN _line_node other ON other.x = source.x AND other.y = source.y AND other.osm_id != source.osm_id WHERE source.isstart OR source.isend;
+
+  ## group same-named highway segments into streets: connected components (union-find) of the graph
+  # whose edges are same-named highways which share a node or are less than --namegap apart (so that
+  # both halves of split carriageways end up in the same group). every named highway gets the
+  # smallest osm_id of its group as its name_group, and the number of ways in the group.
+  # only highways which share their name with a new highway, or with one that was deleted or changed by this import
+  # (which can split or shrink its street), have to be (re-)grouped
+  newnames = "(SELECT name FROM _line WHERE generation IS NULL AND highway IS NOT NULL AND name IS NOT NULL UNION SELECT name FROM _line_node_removed WHERE name IS NOT NULL)"
+  print(f"Grouping {getcount('_line WHERE highway IS NOT NULL AND name IN ' + newnames)} named highway segments into streets...")
+  t = time.time()
+  parent = {}
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  cur.execute(f"SELECT DISTINCT osm_id FROM _line WHERE highway IS NOT NULL AND name IN {newnames}")
+  for (osm_id,) in cur:
+    parent[osm_id] = osm_id
+  edges = conn.cursor(name='name_group_edges')
+  edges.itersize = 100000
+  # (the bbox prefilter in degrees is generous enough for all latitudes up to ~75 degrees)
+  edges.execute(f"""SELECT DISTINCT a.osm_id, b.osm_id FROM _line_node a JOIN _line_node b ON b.x = a.x AND b.y = a.y AND b.osm_id > a.osm_id AND b.name = a.name WHERE a.name IN {newnames}
+    UNION SELECT a.osm_id, b.osm_id FROM _line a JOIN _line b ON b.name = a.name AND b.osm_id > a.osm_id AND a.way && ST_Expand(b.way, {5 * args.namegap / 111320})
+      WHERE a.highway IS NOT NULL AND b.highway IS NOT NULL AND a.name IN {newnames} AND ST_DWithin(Geography(a.way), Geography(b.way), {args.namegap})""")
+  nedges = 0
+  for (a, b) in edges:
+    (a, b) = (find(a), find(b))
+    if a != b:
+      parent[max(a, b)] = min(a, b)
+    nedges += 1
+  edges.close()
+
+  groups = {osm_id: find(osm_id) for osm_id in parent}
+  groupsizes = {}
+  for group in groups.values():
+    groupsizes[group] = groupsizes.get(group, 0) + 1
+  print(f"{len(groups)} highways connected by {nedges} edges form {len(groupsizes)} streets ({time.time() - t}s)\n")
+
+  cur.execute("CREATE TEMPORARY TABLE _name_group (osm_id BIGINT, name_group BIGINT, name_groupsize INTEGER) ON COMMIT DROP")
+  cur.copy_from(io.StringIO(''.join(f"{osm_id}\t{group}\t{groupsizes[group]}\n" for (osm_id, group) in groups.items())), '_name_group')
+  execute("Writing name_group and name_groupsize columns...",
+    "UPDATE _line SET name_group = g.name_group, name_groupsize = g.name_groupsize FROM _name_group g WHERE _line.osm_id = g.osm_id AND _line.highway IS NOT NULL AND (_line.name_group IS DISTINCT FROM g.name_group OR _line.name_groupsize IS DISTINCT FROM g.name_groupsize)")
 
   # this column can be used to try and fit as small a possible a label onto the segment in QGIS (in particular half font-height line break labels for primary and secondary roads and their bridges!)
-  singlynamed = execute(f"Marking highway segments which are singly named (not connected to any same-named highways)",
-    # TODO use ST_Intersects instead (faster?)
-    """UPDATE _line hw SET singlynamed = true WHERE hw.highway IS NOT NULL AND hw.singlynamed IS NULL AND hw.name IS NOT NULL
-        AND NOT EXISTS (SELECT 1 FROM _line adjacent WHERE adjacent.highway IS NOT NULL AND hw.name = adjacent.name AND ST_Touches(hw.way, adjacent.way))""")
-  # rough solution: undo suspicious duplicates based on counts with the same name.
-  # (better way to do this right in the first place would be with buffers instead of simple ST_Touches....)
-  execute(f"Testing {singlynamed} singly-named highways if they might not have been marked singly-named on accident...",
-    "UPDATE _line hw SET singlynamed = false WHERE hw.singlynamed AND (SELECT COUNT(*) FROM _line WHERE singlynamed AND name = hw.name) > 1;")
+  execute(f"Marking highway segments which are singly named (the only segment of their street)",
+    f"UPDATE _line SET singlynamed = name_groupsize = 1 WHERE highway IS NOT NULL AND name IN {newnames} AND singlynamed IS DISTINCT FROM (name_groupsize = 1)")
 
   # TODO actually create an "amenities" view which has a union of points + polygon centroids for railway=station and the relevant amenities to be rendered
   # FIXME this is broken, something about no. of columns?
@@ -169,24 +522,84 @@ try:
 #    f"INSERT INTO _point SELECT {cols}, ST_Centroid(way) AS way FROM _polygon WHERE railway = 'station'")
 
   execute("Capitalising names of large train_stations",
-    "UPDATE _point station SET name = UPPER(station.name) FROM _polygon bldg WHERE bldg.building = 'train_station' AND (station.public_transport = 'station' OR station.railway = 'station') AND bldg.name = station.name AND ST_Within(station.way, bldg.way) AND bldg.area > 10000;")
+    f"UPDATE _point station SET name = UPPER(station.name) FROM _polygon bldg WHERE bldg.building = 'train_station' AND (station.public_transport = 'station' OR station.railway = 'station') AND bldg.name = station.name AND ST_Within(station.way, bldg.way) AND bldg.area > 10000 AND ({isnew('station')} OR {isnew('bldg')});")
   execute("Removing names of train station areas if they contain a train_station point (of the same name) inside them",
-    "UPDATE _polygon bldg SET name = NULL FROM _point station WHERE bldg.building = 'train_station' AND (station.public_transport = 'station' OR station.railway = 'station') AND bldg.name = station.name AND ST_Within(station.way, bldg.way)")
+    f"UPDATE _polygon bldg SET name = NULL FROM _point station WHERE bldg.building = 'train_station' AND (station.public_transport = 'station' OR station.railway = 'station') AND bldg.name = station.name AND ST_Within(station.way, bldg.way) AND ({isnew('station')} OR {isnew('bldg')})")
 
   execute("Transfering point 'place' tags to co-located non-place residential areas with the same name",
-    "UPDATE _polygon a SET place = p.place FROM _point p WHERE a.place IS NULL AND a.landuse = 'residential' AND p.place IS NOT NULL AND p.name = a.name AND ST_Intersects(ST_Buffer(geography(p.way), 100), a.way)")
+    f"UPDATE _polygon a SET place = p.place FROM _point p WHERE a.place IS NULL AND a.landuse = 'residential' AND p.place IS NOT NULL AND p.name = a.name AND ({isnew('a')} OR {isnew('p')}) AND ST_Intersects(ST_Buffer(geography(p.way), 100), a.way)")
   execute("Dropping point 'place's if they are within a 'place'-area with the same name",
-    "DELETE FROM _point p USING _polygon a WHERE p.place IS NOT NULL AND p.place = a.place AND p.name = a.name AND ST_Intersects(ST_Buffer(geography(p.way), 100), a.way);")
+    f"DELETE FROM _point p USING _polygon a WHERE p.place IS NOT NULL AND p.place = a.place AND p.name = a.name AND ({isnew('a')} OR {isnew('p')}) AND ST_Intersects(ST_Buffer(geography(p.way), 100), a.way);")
 
   execute("Removing ; from line and polygon names",
-    """UPDATE _polygon SET name = SUBSTRING(name FOR POSITION(';' IN name) - 1) WHERE name IS NOT NULL AND POSITION(';' IN name) > 0;
-    UPDATE _line SET ref = SUBSTRING(ref FOR POSITION(';' IN ref) - 1) WHERE ref IS NOT NULL AND POSITION(';' IN ref) > 0;""")
+    f"""UPDATE _polygon SET name = SUBSTRING(name FOR POSITION(';' IN name) - 1) WHERE {isnew('_polygon')} AND name IS NOT NULL AND POSITION(';' IN name) > 0;
+    UPDATE _line SET ref = SUBSTRING(ref FOR POSITION(';' IN ref) - 1) WHERE {isnew('_line')} AND ref IS NOT NULL AND POSITION(';' IN ref) > 0;""")
+
+  # geometry pyramid: a simplified copy of every line and polygon per (scale, tolerance, algorithm) level, in side
+  # tables _line_pyramid and _polygon_pyramid (osm_id, level, way) with one partial GiST index per level. the levels
+  # are kept in _pyramid_levels, so that later imports only have to simplify the new rows. pyramid_level(scale)
+  # returns the level for a map scale (NULL for scales larger than all levels, i.e. read the full way), e.g. as a
+  # QGIS layer source: (SELECT p.*, y.way AS pyramid FROM _polygon p JOIN _polygon_pyramid y USING (osm_id) WHERE y.level = pyramid_level(25000))
+  # (built last, after all steps that add or remove rows such as the roundabouts copied to _line, since the rows
+  # only count as new until they are marked as post-processed below)
+  cur.execute("SELECT 1 FROM information_schema.tables WHERE table_name = '_pyramid_levels'")
+  if args.pyramid != None or cur.fetchone() != None:
+    cur.execute("""CREATE TABLE IF NOT EXISTS _pyramid_levels (level SMALLINT PRIMARY KEY, scale INTEGER NOT NULL, tolerance FLOAT NOT NULL, algorithm TEXT NOT NULL);
+      CREATE TABLE IF NOT EXISTS _line_pyramid (osm_id BIGINT NOT NULL, level SMALLINT NOT NULL, way geometry(Geometry,4326) NOT NULL);
+      CREATE TABLE IF NOT EXISTS _polygon_pyramid (osm_id BIGINT NOT NULL, level SMALLINT NOT NULL, way geometry(Geometry,4326) NOT NULL);
+      CREATE INDEX IF NOT EXISTS _line_pyramid_osm_id_idx ON _line_pyramid (osm_id, level);
+      CREATE INDEX IF NOT EXISTS _polygon_pyramid_osm_id_idx ON _polygon_pyramid (osm_id, level);""")
+    cur.execute("SELECT level, scale, tolerance, algorithm FROM _pyramid_levels ORDER BY level")
+    oldlevels = { level: (scale, tolerance, algorithm) for (level, scale, tolerance, algorithm) in cur.fetchall() }
+    # levels are numbered by increasing scale
+    levels = dict(enumerate(sorted(args.pyramid), 1)) if args.pyramid != None else oldlevels
+    # levels which were redefined (or removed) are dropped and recomputed for all rows, the others only for new rows
+    changed = sorted(level for level in set(oldlevels) | set(levels) if oldlevels.get(level) != levels.get(level))
+    # (a level is only recorded in _pyramid_levels once it is complete, so this also removes the rows of a level whose
+    # computation failed halfway)
+    for level in changed:
+      execute(f"Dropping pyramid level {level}" + (f" (1:{oldlevels[level][0]}, {oldlevels[level][2]} tolerance={oldlevels[level][1]})" if level in oldlevels else "") + "...",
+        f"""DELETE FROM _pyramid_levels WHERE level = {level};
+        DROP INDEX IF EXISTS _line_pyramid_{level}_idx; DROP INDEX IF EXISTS _polygon_pyramid_{level}_idx;
+        DELETE FROM _line_pyramid WHERE level = {level}; DELETE FROM _polygon_pyramid WHERE level = {level};""")
+    for table in ['_line', '_polygon']:
+      # (objects which were changed by this import have been re-added as new rows, deleted objects are gone. this also
+      # removes the rows that a failed run already inserted for new rows)
+      execute(f"Removing pyramid geometries of changed and deleted {table} rows...",
+        f"DELETE FROM {table}_pyramid y WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.osm_id = y.osm_id AND t.generation IS NOT NULL)")
+
+    for (level, (scale, tolerance, algorithm)) in levels.items():
+      pyramid = inlocal(lambda local: PYRAMIDALGORITHMS[algorithm].format(local, tolerance))
+      for table in ['_line', '_polygon']:
+        rows = 'TRUE' if level in changed else isnew(table)
+        # (geometries which collapse at this level are left out, they are too small to be drawn)
+        execute(f"Simplifying {getcount(f'{table} WHERE {rows}')} {table} rows for pyramid level {level} (1:{scale}, {algorithm} tolerance={tolerance})...",
+          lambda inpartition: f"INSERT INTO {table}_pyramid SELECT osm_id, {level}, way FROM (SELECT osm_id, {pyramid} AS way FROM {table} WHERE {inpartition('osm_id')} AND {rows}) simplified WHERE NOT ST_IsEmpty(way)", partition=table)
+        if level in changed:
+          execute(f"Indexing {table} pyramid level {level}", f"CREATE INDEX {table}_pyramid_{level}_idx ON {table}_pyramid USING GIST (way) WHERE level = {level};")
+      if level in changed:
+        cur.execute("INSERT INTO _pyramid_levels VALUES (%s, %s, %s, %s)", (level, scale, tolerance, algorithm))
+        conn.commit()
+    # (IMMUTABLE, with the scales of the levels written into it, so that the planner folds pyramid_level(25000) into
+    # a constant and can use the partial index of that level. it is recreated whenever the levels change)
+    cases = ' '.join(f"WHEN $1 >= {scale} THEN {level}" for (level, (scale, tolerance, algorithm)) in sorted(levels.items(), reverse=True))
+    execute(f"Creating pyramid_level(scale) function for {len(levels)} levels",
+      f"CREATE OR REPLACE FUNCTION pyramid_level(scale FLOAT) RETURNS SMALLINT AS $$ SELECT {f'CASE {cases} END' if cases else 'NULL'}::SMALLINT $$ LANGUAGE SQL IMMUTABLE;")
+    execute("Analyzing pyramid tables", "ANALYZE _line_pyramid; ANALYZE _polygon_pyramid;", commit=True)
+    print(f"Pyramid sizes: _line_pyramid {gettablesize('_line_pyramid')}, _polygon_pyramid {gettablesize('_polygon_pyramid')}\n")
 
+  for table in ['_point', '_line', '_polygon']:
+    execute(f"Marking new {table} rows as post-processed (import generation {generation})",
+      f"UPDATE {table} SET generation = {generation} WHERE generation IS NULL")
+  execute("Clearing the nodes of deleted and changed highways", "TRUNCATE _line_node_removed")
+  conn.commit()
 
   cur.close()
 
 except (Exception, psycopg2.DatabaseError) as error:
   print(error)
 finally:
+  if pool is not None:
+    pool.closeall()
   if conn is not None:
       conn.close()
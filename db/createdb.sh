@@ -9,6 +9,8 @@ DBNAME=za
 createdb -U postgres $DBNAME
 psql -U postgres -d $DBNAME -c 'CREATE EXTENSION postgis; CREATE EXTENSION hstore;'
 sudo -u postgres createuser $DBNAME
+# (for ./adddata.py --simplifycell)
+psql -U postgres -d $DBNAME -c "GRANT INSERT, UPDATE ON spatial_ref_sys TO $DBNAME;"
 # && ./adddata.sh data/*.osm
 
 # psql -d "$DB" -c "DROP VIEW districts; CREATE VIEW districts AS SELECT id, boundary, admin_level, name, ST_MakePolygon(parts) AS geometry FROM _rels WHERE
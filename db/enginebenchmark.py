@@ -0,0 +1,64 @@
+#!/usr/local/bin/python3
+
+# compare adddata.py's SQL and python engine (--engine) for the length and area columns on the current
+# database: both are timed recomputing the columns for all rows (in a transaction that is rolled back, so the
+# database is left unchanged), and their results compared row by row. e.g. for the small cutouts:
+# ./adddata.py --bbox -3.2315 55.9265 -3.1548 55.9582 -- data/Edinburgh.osm.pbf && ./enginebenchmark.py
+# ./adddata.py --bbox 102.66 25.033 102.73 25.085 -- data/Kunming.osm.pbf && ./enginebenchmark.py
+
+import argparse
+import os
+import time
+from statistics import median
+
+import numpy as np
+import psycopg2
+
+import geometryengine
+
+parser = argparse.ArgumentParser(description="Time computing the length and area columns with adddata.py's SQL UPDATEs against the python engine, and compare their results.")
+parser.add_argument('--user', default='za')
+parser.add_argument('--db', default='za')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of python engine worker processes')
+parser.add_argument('-n', type=int, default=3, help='number of timed runs per engine')
+args = parser.parse_args()
+
+COLUMNS = [('_line', 'length', 'ST_Length(way, false)'), ('_polygon', 'area', 'ST_Area(Geography(way))')]
+
+# recompute column of all rows with one engine, returns (seconds, { osm_id: value } of the unique osm_ids)
+def run(conn, table, column, expression, engine):
+  cur = conn.cursor()
+  try:
+    cur.execute(f"UPDATE {table} SET {column} = NULL")
+    t = time.time()
+    if engine == 'python':
+      geometryengine.computecolumn(conn, table, column, args.processes)
+    # (the SQL engine computes everything here, the python engine only the rows it couldn't match by osm_id)
+    cur.execute(f"UPDATE {table} SET {column} = {expression} WHERE {column} IS NULL")
+    seconds = time.time() - t
+    cur.execute(f"SELECT osm_id, MIN({column}) FROM {table} GROUP BY osm_id HAVING COUNT(*) = 1")
+    return (seconds, dict(cur.fetchall()))
+  finally:
+    conn.rollback()
+
+conn = psycopg2.connect(host="localhost", user=args.user, database=args.db)
+try:
+  print(f"{'column':16} {'rows':>9} {'sql':>10} {'python':>10} {'speedup':>8} {'max diff':>9}")
+  for (table, column, expression) in COLUMNS:
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM {table}")
+    rows = cur.fetchone()[0]
+    conn.rollback()
+    times = {}
+    for engine in ['sql', 'python']:
+      runs = [ run(conn, table, column, expression, engine) for i in range(args.n) ]
+      times[engine] = median(seconds for (seconds, values) in runs)
+      results = runs[-1][1]
+      if engine == 'sql':
+        reference = results
+    # (both store rounded values, so they can differ by 1 where the exact value is close to .5)
+    osmids = list(reference)
+    maxdiff = int(np.max(np.abs(np.array([ reference[osmid] for osmid in osmids ]) - np.array([ results[osmid] for osmid in osmids ])), initial=0))
+    print(f"{table + '.' + column:16} {rows:9} {times['sql']:9.2f}s {times['python']:9.2f}s {times['sql'] / times['python']:7.2f}x {maxdiff:9}")
+finally:
+  conn.close()
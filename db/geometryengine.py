@@ -0,0 +1,79 @@
+# python engine for the per-geometry columns of adddata.py (--engine python): instead of computing length and
+# area row by row in UPDATEs, the rows are streamed out as WKB in big batches through a server-side cursor,
+# computed with shapely/numpy (length) and pyproj (area) in a process pool, and copied back into a staging
+# table which then updates the table in one join by osm_id. results are the same as the SQL expressions:
+#   length: ST_Length(way, false), great circle distances on the mean-radius sphere
+#   area: ST_Area(Geography(way)), geodesic area on the WGS84 ellipsoid (both via GeographicLib)
+
+import io
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import shapely
+from pyproj import Geod
+
+# sphere radius of ST_Length(geography, false): the mean radius (2a + b) / 3 of WGS84
+RADIUS = 6371008.771415
+
+GEOD = Geod(ellps='WGS84')
+
+# returns the great circle length in m of every (multi)linestring
+def getlengths(geoms):
+  # (segments only connect consecutive coordinates of the same part)
+  (parts, partindex) = shapely.get_parts(geoms, return_index=True)
+  (coords, coordindex) = shapely.get_coordinates(parts, return_index=True)
+  (lon, lat) = np.radians(coords).T
+  a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+  distances = 2 * RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+  segments = coordindex[1:] == coordindex[:-1]
+  partlengths = np.bincount(coordindex[:-1][segments], weights=distances[segments], minlength=len(parts))
+  return np.bincount(partindex, weights=partlengths, minlength=len(geoms))
+
+# returns the geodesic area in m^2 of every (multi)polygon
+def getareas(geoms):
+  (parts, partindex) = shapely.get_parts(geoms, return_index=True)
+  (rings, ringindex) = shapely.get_rings(parts, return_index=True)
+  # the first ring of every polygon is its exterior, all others are holes
+  exterior = np.ones(len(rings), dtype=bool)
+  exterior[1:] = ringindex[1:] != ringindex[:-1]
+  # (all coordinates are extracted at once, only the geodesic ring area is computed ring by ring)
+  coords = shapely.get_coordinates(rings)
+  ends = np.cumsum(shapely.get_num_coordinates(rings))
+  ringareas = np.array([ abs(GEOD.polygon_area_perimeter(coords[start:end, 0], coords[start:end, 1])[0]) for (start, end) in zip(np.concatenate(([0], ends[:-1])), ends) ])
+  partareas = np.bincount(ringindex, weights=np.where(exterior, ringareas, -ringareas), minlength=len(parts))
+  return np.bincount(partindex, weights=partareas, minlength=len(geoms))
+
+COLUMNS = { 'length': getlengths, 'area': getareas }
+
+# computes one batch in a worker process, returns the COPY text of (osm_id, value) rows
+def computebatch(column, osmids, wkbs):
+  values = np.rint(COLUMNS[column](shapely.from_wkb(wkbs))).astype(np.int64)
+  return ''.join(f'{osmid}\t{value}\n' for (osmid, value) in zip(osmids, values.tolist()))
+
+# fills column (length or area) of all rows of table where it IS NULL, returns the number of rows updated.
+# rows whose osm_id is not unique (e.g. long ways which osm2pgsql split into several rows) can't be matched
+# by osm_id and are left NULL, for the SQL UPDATE to pick up. the staging table is dropped on commit
+def computecolumn(conn, table, column, processes, batchsize = 50000):
+  staging = f'_{column}_staging'
+  cur = conn.cursor()
+  cur.execute(f"CREATE TEMPORARY TABLE {staging} (osm_id BIGINT, {column} BIGINT) ON COMMIT DROP")
+  reader = conn.cursor(name=f'{table}_{column}_reader')
+  reader.itersize = batchsize
+  reader.execute(f"SELECT osm_id, ST_AsBinary(way) FROM {table} WHERE {column} IS NULL AND way IS NOT NULL")
+  # (fetching, computing and copying overlap, with at most two batches per process in flight)
+  with ProcessPoolExecutor(processes) as executor:
+    pending = set()
+    while True:
+      rows = reader.fetchmany(batchsize)
+      if len(rows) > 0:
+        pending.add(executor.submit(computebatch, column, [ osmid for (osmid, wkb) in rows ], [ bytes(wkb) for (osmid, wkb) in rows ]))
+      if len(pending) == 0:
+        break
+      if len(rows) == 0 or len(pending) >= 2 * processes:
+        (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          cur.copy_from(io.StringIO(future.result()), staging)
+  reader.close()
+  cur.execute(f"DELETE FROM {staging} WHERE osm_id IN (SELECT osm_id FROM {staging} GROUP BY osm_id HAVING COUNT(*) > 1)")
+  cur.execute(f"UPDATE {table} SET {column} = s.{column} FROM {staging} s WHERE {table}.osm_id = s.osm_id AND {table}.{column} IS NULL")
+  return cur.rowcount
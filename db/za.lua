@@ -0,0 +1,263 @@
+-- osm2pgsql flex output version of za.style (./adddata.py --flex): creates the _point, _line, _polygon and
+-- _roads tables of the pgsql output with the za.style columns, and also fills some of the columns that
+-- adddata.py otherwise adds with one UPDATE pass over the whole table each (area, simplified for lines,
+-- direction and the layer/oneway/bridge/tunnel = 0/'no' cleanup).
+-- differences to za.style: _line and _polygon already have adddata.py's extra columns.
+-- this does not make a fresh import write every row only once: length (the flex geometry API has no access
+-- to the vertices, so the spherical length of ST_Length(way, false) can't be computed), simplified for
+-- polygons (geom:simplify() only handles lines), simplified2 and geometries that collapse when simplified
+-- are left NULL and filled in by the UPDATE pipeline as before, so adddata.py still rewrites every _line row
+-- (length) and every _polygon row (simplified) once after the import. only the separate area, direction,
+-- cleanup and line simplification passes are saved.
+-- two columns are computed differently than in SQL:
+--  * area is the area on a sphere (geom:spherical_area()), while ST_Area(Geography(way)) uses the WGS84
+--    ellipsoid, so areas differ from SQL-computed ones by up to about 0.7% depending on the latitude, which
+--    can also put polygons very close to --minarea on the other side of it.
+--  * lines are simplified with plain Douglas-Peucker with the tolerance in degrees of latitude here, while
+--    the UPDATE uses ST_SimplifyPreserveTopology in a local projection in m, so the simplified lines of flex
+--    imports differ slightly from SQL-simplified ones (both stay within the tolerance).
+
+-- simplification tolerance in m (adddata.py --simplify)
+local simplify = tonumber(os.getenv('ZA_SIMPLIFY') or '4')
+
+-- text columns of za.style
+local keys = { 'boundary', 'access', 'aeroway', 'amenity', 'admin_level', 'bridge', 'building', 'construction',
+  'covered', 'emergency', 'highway', 'historic', 'junction', 'landuse', 'leisure', 'man_made', 'military', 'name',
+  'natural', 'office', 'oneway', 'place', 'power', 'power_source', 'public_transport', 'railway', 'ref',
+  'religion', 'route', 'service', 'shop', 'station', 'tourism', 'tunnel', 'type', 'water', 'waterway', 'wetland',
+  'width', 'wood' }
+
+-- closed ways with any of these keys are polygons (the 'polygon' flag in za.style)
+local polygonkeys = { 'access', 'aeroway', 'amenity', 'building', 'building:part', 'emergency', 'harbour',
+  'historic', 'landuse', 'leisure', 'man_made', 'military', 'natural', 'office', 'place', 'power',
+  'public_transport', 'religion', 'shop', 'sport', 'tourism', 'water', 'waterway', 'wetland',
+  'abandoned:aeroway', 'abandoned:amenity', 'abandoned:building', 'abandoned:landuse', 'abandoned:power',
+  'area:highway' }
+
+local function getcolumns(extra)
+  local columns = {}
+  for _, key in ipairs(keys) do
+    table.insert(columns, { column = key, type = 'text' })
+  end
+  table.insert(columns, { column = 'layer', type = 'int4' })
+  for _, column in ipairs(extra) do
+    table.insert(columns, column)
+  end
+  return columns
+end
+
+local tables = {}
+
+tables.point = osm2pgsql.define_table({
+  name = '_point',
+  ids = { type = 'node', id_column = 'osm_id' },
+  columns = getcolumns({
+    { column = 'way', type = 'point', projection = 4326, not_null = true } })
+})
+
+-- (ways get positive, relations negative osm_ids, like the pgsql output)
+-- the subset of _line which the pgsql output also writes to its roads table (see isroad)
+tables.roads = osm2pgsql.define_table({
+  name = '_roads',
+  ids = { type = 'area', id_column = 'osm_id' },
+  columns = getcolumns({
+    { column = 'z_order', type = 'int4' },
+    { column = 'way', type = 'geometry', projection = 4326, not_null = true } }),
+  indexes = {
+    { column = 'way', method = 'gist' } }
+})
+
+tables.line = osm2pgsql.define_table({
+  name = '_line',
+  ids = { type = 'area', id_column = 'osm_id' },
+  columns = getcolumns({
+    { column = 'z_order', type = 'int4' },
+    { column = 'way', type = 'geometry', projection = 4326, not_null = true },
+    { column = 'length', type = 'int4' },
+    { column = 'direction', type = 'int2' },
+    { column = 'flatcap', type = 'bool', not_null = true },
+    { column = 'singlynamed', type = 'bool' },
+    { column = 'simplified', type = 'geometry', projection = 4326 } }),
+  indexes = {
+    { column = 'way', method = 'gist' },
+    { column = 'simplified', method = 'gist' } }
+})
+
+tables.polygon = osm2pgsql.define_table({
+  name = '_polygon',
+  ids = { type = 'area', id_column = 'osm_id' },
+  columns = getcolumns({
+    { column = 'z_order', type = 'int4' },
+    { column = 'way', type = 'geometry', projection = 4326, not_null = true },
+    { column = 'area', type = 'int8' },
+    { column = 'simplified', type = 'geometry', projection = 4326 },
+    { column = 'simplified2', type = 'geometry', projection = 4326 } }),
+  indexes = {
+    { column = 'way', method = 'gist' },
+    { column = 'simplified', method = 'gist' },
+    { column = 'simplified2', method = 'gist' } }
+})
+
+-- z_order like the pgsql output (roughly): layer first, then bridges/tunnels, then road class
+local roadorder = { proposed = 1, construction = 2, steps = 10, cycleway = 10, bridleway = 10, footway = 10,
+  path = 10, track = 11, service = 15, tertiary_link = 24, secondary_link = 25, primary_link = 27,
+  trunk_link = 28, motorway_link = 29, raceway = 30, pedestrian = 31, living_street = 32, road = 33,
+  unclassified = 33, residential = 33, tertiary = 34, secondary = 36, primary = 37, trunk = 38, motorway = 39 }
+
+local function getzorder(tags, layer)
+  local z = 100 * (layer or 0) + (roadorder[tags.highway] or 0)
+  if tags.railway then
+    z = z + 35
+  end
+  if tags.bridge and tags.bridge ~= 'no' then
+    z = z + 100
+  end
+  if tags.tunnel and tags.tunnel ~= 'no' then
+    z = z - 100
+  end
+  return z
+end
+
+-- highways which the pgsql output also writes to the roads table
+local roadhighways = { secondary_link = true, primary_link = true, trunk_link = true, motorway_link = true,
+  secondary = true, primary = true, trunk = true, motorway = true }
+
+-- like the pgsql output: major roads, railways and administrative boundaries
+local function isroad(tags)
+  return roadhighways[tags.highway] or tags.railway ~= nil or tags.boundary == 'administrative'
+end
+
+local function getlayer(tags)
+  local layer = tonumber(tags.layer)
+  if layer and layer == math.floor(layer) then
+    return layer
+  end
+  return nil
+end
+
+local function hascolumns(tags)
+  if tags.layer then
+    return true
+  end
+  for _, key in ipairs(keys) do
+    if tags[key] then
+      return true
+    end
+  end
+  return false
+end
+
+local function ispolygon(tags)
+  if tags.area == 'yes' then
+    return true
+  elseif tags.area == 'no' then
+    return false
+  end
+  for _, key in ipairs(polygonkeys) do
+    if tags[key] then
+      return true
+    end
+  end
+  return false
+end
+
+local function getrow(tags)
+  local row = {}
+  for _, key in ipairs(keys) do
+    row[key] = tags[key]
+  end
+  row.layer = getlayer(tags)
+  return row
+end
+
+-- (lines only, geom:simplify() returns a null geometry for polygons.) the simplification tolerance is
+-- converted to degrees of latitude, so east-west (where degrees are shorter) lines are simplified a bit less
+-- than the tolerance, never more
+local function getsimplified(geom)
+  local simplified = geom:simplify(simplify / 111320)
+  if simplified:is_null() then
+    return nil
+  end
+  return simplified
+end
+
+local onewaydirections = { ['1'] = 1, yes = 1, ['-1'] = -1 }
+
+-- oneway arrows point the other way for ways in the UK (like the UPDATE in adddata.py)
+local function getdirection(tags, geom)
+  local direction = onewaydirections[tags.oneway]
+  if direction then
+    local minx, miny, maxx, maxy = geom:get_bbox()
+    if minx > -12 and maxx < 2 and miny > 50 and maxy < 61 then
+      direction = -direction
+    end
+  end
+  return direction
+end
+
+local function addline(tags, geom)
+  if geom:is_null() then
+    return
+  end
+  local row = getrow(tags)
+  row.z_order = getzorder(tags, row.layer)
+  if isroad(tags) then
+    -- (as imported, without the cleanup below, which adddata.py only does on _line)
+    local road = getrow(tags)
+    road.z_order = row.z_order
+    road.way = geom
+    tables.roads:insert(road)
+  end
+  -- (drop the tags that adddata.py would otherwise set to NULL)
+  if row.layer == 0 then
+    row.layer = nil
+  end
+  for _, key in ipairs({ 'oneway', 'bridge', 'tunnel' }) do
+    if row[key] == 'no' then
+      row[key] = nil
+    end
+  end
+  row.way = geom
+  row.direction = getdirection(tags, geom)
+  row.flatcap = false
+  row.simplified = getsimplified(geom)
+  tables.line:insert(row)
+end
+
+local function addpolygon(tags, geom)
+  if geom:is_null() then
+    return
+  end
+  local row = getrow(tags)
+  row.z_order = getzorder(tags, row.layer)
+  row.way = geom
+  row.area = math.floor(geom:spherical_area() + 0.5)
+  tables.polygon:insert(row)
+end
+
+function osm2pgsql.process_node(object)
+  if hascolumns(object.tags) then
+    local row = getrow(object.tags)
+    row.way = object:as_point()
+    tables.point:insert(row)
+  end
+end
+
+function osm2pgsql.process_way(object)
+  local tags = object.tags
+  if object.is_closed and ispolygon(tags) then
+    addpolygon(tags, object:as_polygon())
+  elseif hascolumns(tags) then
+    addline(tags, object:as_linestring())
+  end
+end
+
+function osm2pgsql.process_relation(object)
+  local tags = object.tags
+  if tags.type == 'multipolygon' or tags.type == 'boundary' then
+    addpolygon(tags, object:as_multipolygon())
+  end
+  if tags.type == 'boundary' or tags.type == 'route' then
+    addline(tags, object:as_multilinestring():line_merge())
+  end
+end
@@ -0,0 +1,290 @@
+#!/usr/local/bin/python3
+
+# headless atlas export: the atlas features of a layout in ZA2.qgs are split into chunks which are rendered
+# in parallel by worker processes (each with its own QgsApplication and copy of the project), one PDF (or PNG)
+# per atlas page. the per-page PDFs are then merged in atlas order, ready for printing/mergeandcut.sh.
+# exports are incremental: a manifest in the page directory records for every page a key made up of its extent
+# (from atlas.geojson), the layout itself plus the map themes and style elements of the layers it shows, and the
+# count/last import generation of the data in its extent. only pages whose key changed are rendered again, and
+# the manifest is written after every finished page so that an interrupted export resumes where it stopped.
+# ./export.py Kunming -jobs 8
+
+import argparse
+import json
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from hashlib import sha256
+from multiprocessing import get_context
+from xml.etree.ElementTree import fromstring
+
+from qgspatch import scan
+
+parser = argparse.ArgumentParser(description='Export the atlas of a layout in a QGIS project page by page in parallel worker processes, then merge the pages in atlas order. Only pages whose inputs changed since the last export are rendered again.')
+parser.add_argument('layout', help='name of the atlas layout (the atlas file name as used by layout.py, e.g. Kunming)')
+parser.add_argument('-project', default='ZA2.qgs', help='QGIS project file')
+parser.add_argument('-geojson', default=None, help='atlas geojson used by the project (default: atlas.geojson next to the project)')
+parser.add_argument('-o', default=None, help='merged output file (default: LAYOUT.pdf, as expected by printing/mergeandcut.sh)')
+parser.add_argument('-pagedir', default=None, help='directory for the individual page files, render timings and the export manifest (default: export-LAYOUT/)')
+parser.add_argument('-format', choices=['pdf', 'png'], default='pdf', help='per-page output format (png pages are not merged)')
+parser.add_argument('-dpi', type=int, default=None, help='export resolution (default: the printResolution of the layout)')
+parser.add_argument('-norasterize', default=False, action='store_true', help='export pdf pages as vectors instead of rasterizing the whole page')
+parser.add_argument('-overview', default=False, action='store_true', help='also export the "LAYOUT overview" layout (to "LAYOUT overview.pdf")')
+parser.add_argument('-jobs', type=int, default=os.cpu_count(), help='number of parallel QGIS worker processes')
+parser.add_argument('-chunksize', type=int, default=None, help='number of consecutive atlas pages per work unit (default: spread pages over 4 chunks per worker)')
+parser.add_argument('-force', default=False, action='store_true', help='render all pages, even the ones that are unchanged according to the manifest')
+parser.add_argument('-db', default='za', help='PostGIS database whose data is rendered (to detect pages with changed data)')
+parser.add_argument('-dbuser', default='za')
+parser.add_argument('-dbhost', default='localhost')
+
+# every worker process opens the project once and keeps it for all of its chunks
+worker = {}
+
+def initworker(projectfile, progress):
+  os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+  from qgis.core import QgsApplication, QgsProject
+  worker['app'] = QgsApplication([], False)
+  worker['app'].initQgis()
+  worker['project'] = QgsProject.instance()
+  if not worker['project'].read(projectfile):
+    raise RuntimeError(f'Could not read {projectfile}')
+  worker['progress'] = progress
+
+def getlayout(layoutname):
+  layout = worker['project'].layoutManager().layoutByName(layoutname)
+  if layout == None:
+    raise ValueError(f'No layout named "{layoutname}" in the project')
+  return layout
+
+def exportfile(exporter, filename, format, dpi, rasterize):
+  from qgis.core import QgsLayoutExporter
+  if format == 'pdf':
+    settings = QgsLayoutExporter.PdfExportSettings()
+    settings.rasterizeWholeImage = rasterize
+    if dpi:
+      settings.dpi = dpi
+    result = exporter.exportToPdf(filename, settings)
+  else:
+    settings = QgsLayoutExporter.ImageExportSettings()
+    if dpi:
+      settings.dpi = dpi
+    result = exporter.exportToImage(filename, settings)
+  if result != QgsLayoutExporter.Success:
+    raise RuntimeError(f'Exporting {filename} failed ({exporter.errorMessage()})')
+
+# returns the number of atlas features of a layout
+def countpages(layoutname):
+  atlas = getlayout(layoutname).atlas()
+  return atlas.updateFeatures()
+
+# renders the given [ (atlas feature index, filename) ], reporting (index, filename, seconds) for every finished page
+def exportchunk(layoutname, pages, format, dpi, rasterize):
+  from qgis.core import QgsLayoutExporter
+  layout = getlayout(layoutname)
+  atlas = layout.atlas()
+  exporter = QgsLayoutExporter(layout)
+  atlas.beginRender()
+  try:
+    for (i, filename) in pages:
+      if not atlas.seekTo(i):
+        raise RuntimeError(f'Could not seek to atlas feature {i} of {layoutname}')
+      # (render to a temporary file first so that an interrupted export never leaves a truncated page behind)
+      tmpfilename = os.path.join(os.path.dirname(filename), 'tmp-' + os.path.basename(filename))
+      t = time.perf_counter()
+      exportfile(exporter, tmpfilename, format, dpi, rasterize)
+      os.replace(tmpfilename, filename)
+      worker['progress'].put((i, filename, time.perf_counter() - t))
+  finally:
+    atlas.endRender()
+
+def exportlayout(layoutname, filename, dpi, rasterize):
+  from qgis.core import QgsLayoutExporter
+  t = time.perf_counter()
+  exportfile(QgsLayoutExporter(getlayout(layoutname)), filename, 'pdf', dpi, rasterize)
+  return time.perf_counter() - t
+
+# returns [ (page number, atlas page feature, page polygon) ] in atlas feature order
+def getpages(geojsonfile):
+  with open(geojsonfile) as f:
+    features = json.load(f)['features']
+  polygons = { feature['properties']['page']: feature['geometry'] for feature in features if feature['properties']['type'] == 'atlaspage' and feature['geometry']['type'] == 'Polygon' }
+  return [ (feature['properties']['page'], feature, polygons[feature['properties']['page']])
+    for feature in features if feature['properties']['type'] == 'atlaspage' and feature['geometry']['type'] == 'Point' ]
+
+# the parts of a <maplayer> that change how it is drawn (its start tag with the scale range, labelsEnabled
+# and simplification settings is included as well)
+STYLEELEMENTS = ['datasource', 'provider', 'renderer-v2', 'labeling', 'blendMode', 'featureBlendMode', 'layerOpacity',
+  'map-layer-style-manager', 'expressionfields', 'SingleCategoryDiagramRenderer', 'DiagramLayerSettings', 'pipe']
+
+MAPITEM = '65639'
+
+# returns [ (layer id, style) ] shown by a map theme, plus its checked legend nodes and groups (but not which
+# nodes are expanded in the layer tree)
+def gettheme(preset):
+  return ([ (layer.get('id'), layer.get('style')) for layer in preset.iter('layer') if layer.get('visible') == '1' ],
+    sorted((nodes.get('id'), sorted(node.get('id') for node in nodes)) for nodes in preset.iter('checked-legend-nodes')),
+    sorted(node.get('id') for node in preset.iter('checked-group-node')))
+
+# returns the ids of the layers which are checked in the layer tree (together with all their groups)
+def getcheckedlayers(group):
+  layers = []
+  for node in group:
+    if node.get('checked') == 'Qt::Checked':
+      if node.tag == 'layer-tree-layer':
+        layers.append(node.get('id'))
+      elif node.tag == 'layer-tree-group':
+        layers.extend(getcheckedlayers(node))
+  return layers
+
+# hash of everything in the project that the layout's pages look like: the layout itself, the themes (or
+# layer sets) of its maps, the drawing order and the style elements of the layers they show. canvas extent,
+# layer tree expansion, other layouts etc. are left out, so that saving the project doesn't re-render pages
+def getstylehash(projectfile, layoutname):
+  with open(projectfile, 'rb') as f:
+    data = f.read()
+  offsets = scan(data)
+  if layoutname not in offsets['layout']:
+    raise ValueError(f'No layout named "{layoutname}" in {projectfile}')
+  (layoutstart, layoutend) = offsets['layout'][layoutname]
+  def getelement(name):
+    (start, end) = offsets['elements'].get(name, (0, 0))
+    return fromstring(data[start:end]) if end > start else None
+  presets = getelement('visibility-presets')
+  themes = { preset.get('name'): gettheme(preset) for preset in (presets if presets != None else []) }
+
+  # what every map shows: a theme, a fixed layer set or whatever is checked in the layer tree
+  maps = []
+  layers = set()
+  for item in fromstring(data[layoutstart:layoutend]).iter('LayoutItem'):
+    if item.get('type') != MAPITEM:
+      continue
+    if item.get('followPreset') == 'true' and item.get('followPresetName') in themes:
+      theme = themes[item.get('followPresetName')]
+      maps.append(theme)
+      layers.update(layer for (layer, style) in theme[0])
+    elif item.get('keepLayerSet') == 'true':
+      maps.append([ layer.text for layer in item.iter('Layer') ])
+      layers.update(maps[-1])
+    else:
+      maps.append(getcheckedlayers(getelement('layer-tree-group')))
+      layers.update(maps[-1])
+
+  key = sha256(data[layoutstart:layoutend])
+  key.update(json.dumps(maps).encode())
+  # (drawing order)
+  (start, end) = offsets['elements'].get('layerorder', (0, 0))
+  key.update(data[start:end])
+  for maplayer in sorted((maplayer for maplayer in offsets['maplayers'] if 'id' in maplayer and maplayer['id'][2] in layers), key=lambda maplayer: maplayer['id'][2]):
+    key.update(maplayer['id'][2].encode())
+    key.update(data[maplayer['tag'][0]:maplayer['tag'][1]])
+    for (name, start, end) in maplayer['children']:
+      if name in STYLEELEMENTS:
+        key.update(data[start:end])
+  return key.hexdigest()
+
+# returns { page: [ count, last import generation ] of every table in the page extent } in one query
+# (osm2pgsql --append deletes and re-inserts changed objects, which get a new generation from adddata.py)
+def getdatastamps(conn, pages, tables = ['_point', '_line', '_polygon']):
+  laterals = ' '.join(f'CROSS JOIN LATERAL (SELECT COUNT(*) AS n, MAX(generation) AS g FROM {table} WHERE p.geom && way) s{i}' for (i, table) in enumerate(tables))
+  cur = conn.cursor()
+  cur.execute(f"""SELECT p.page, {', '.join(f's{i}.n, s{i}.g' for i in range(len(tables)))}
+    FROM (SELECT page, ST_GeomFromGeoJSON(geojson) AS geom FROM unnest(%s::int[], %s::text[]) AS pages(page, geojson)) p
+    {laterals}""", ([ page for (page, feature, polygon) in pages ], [ json.dumps(polygon) for (page, feature, polygon) in pages ]))
+  return { row[0]: list(row[1:]) for row in cur.fetchall() }
+
+def writemanifest(filename, manifest):
+  with open(filename + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=1)
+  os.replace(filename + '.tmp', filename)
+
+def mergepdfs(filenames, outfile):
+  import pikepdf
+  # (the source pdfs have to stay open until the merged file is saved)
+  with ExitStack() as stack, pikepdf.Pdf.new() as merged:
+    for filename in filenames:
+      merged.pages.extend(stack.enter_context(pikepdf.open(filename)).pages)
+    merged.save(outfile)
+
+if __name__ == '__main__':
+  import psycopg2
+
+  args = parser.parse_args()
+  outfile = args.o or args.layout + '.pdf'
+  pagedir = os.path.abspath(args.pagedir or 'export-' + args.layout)
+  os.makedirs(pagedir, exist_ok=True)
+  t = time.time()
+
+  pages = getpages(args.geojson or os.path.join(os.path.dirname(os.path.abspath(args.project)), 'atlas.geojson'))
+  stylehash = getstylehash(args.project, args.layout)
+  conn = psycopg2.connect(host=args.dbhost, user=args.dbuser, database=args.db)
+  try:
+    datastamps = getdatastamps(conn, pages)
+  finally:
+    conn.close()
+  settings = [args.format, args.dpi, not args.norasterize]
+  keys = { page: sha256(json.dumps([stylehash, settings, feature['properties'], polygon, datastamps[page]]).encode()).hexdigest()
+    for (page, feature, polygon) in pages }
+  filenames = [ os.path.join(pagedir, f'{page:04d}.{args.format}') for (page, feature, polygon) in pages ]
+
+  manifestfile = os.path.join(pagedir, 'manifest.json')
+  manifest = { 'layout': args.layout, 'pages': {} }
+  if os.path.exists(manifestfile):
+    with open(manifestfile) as f:
+      manifest = json.load(f)
+  def unchanged(i):
+    entry = manifest['pages'].get(str(pages[i][0]))
+    return entry != None and entry['key'] == keys[pages[i][0]] and os.path.exists(filenames[i])
+  todo = [ i for i in range(len(pages)) if args.force or not unchanged(i) ]
+  print(f'{len(pages) - len(todo)} of {len(pages)} atlas pages of {args.layout} unchanged since the last export ({time.time() - t:.1f}s)')
+
+  # (QGIS is not fork-safe, so workers are spawned fresh and initialize their own QgsApplication)
+  context = get_context('spawn')
+  progress = context.Queue()
+  timings = []
+  with ProcessPoolExecutor(args.jobs, mp_context=context, initializer=initworker, initargs=(os.path.abspath(args.project), progress)) as pool:
+    if todo or args.overview:
+      npages = pool.submit(countpages, args.layout).result()
+      if npages != len(pages):
+        raise ValueError(f'The atlas of {args.layout} has {npages} features but the atlas geojson has {len(pages)} pages, was it generated for another layout?')
+    chunksize = args.chunksize or max(1, -(-len(todo) // (4 * args.jobs)))
+    if todo:
+      print(f'Exporting {len(todo)} atlas pages in chunks of {chunksize} over {args.jobs} processes')
+
+    # consecutive pages share most of their data, so keep them in the same chunk
+    futures = [ pool.submit(exportchunk, args.layout, [ (i, filenames[i]) for i in todo[start:start + chunksize] ], args.format, args.dpi, not args.norasterize)
+      for start in range(0, len(todo), chunksize) ]
+    if args.overview:
+      overview = pool.submit(exportlayout, args.layout + ' overview', os.path.abspath(args.layout + ' overview.pdf'), args.dpi, not args.norasterize)
+
+    while len(timings) < len(todo):
+      try:
+        (i, filename, seconds) = progress.get(timeout=1)
+      except queue.Empty:
+        # (surface errors of failed chunks instead of waiting forever)
+        for future in futures:
+          if future.done() and future.exception():
+            raise future.exception()
+        continue
+      page = pages[i][0]
+      print(f'  page {page} ({len(timings) + 1}/{len(todo)}): {seconds:.1f}s')
+      timings.append((i, page, seconds))
+      manifest['pages'][str(page)] = { 'key': keys[page], 'file': os.path.basename(filename), 'seconds': round(seconds, 3) }
+      writemanifest(manifestfile, manifest)
+    if args.overview:
+      print(f'  {args.layout} overview: {overview.result():.1f}s')
+
+  if timings:
+    timings.sort()
+    with open(os.path.join(pagedir, 'timings.csv'), 'w') as f:
+      f.write('index,page,seconds\n')
+      for (i, page, seconds) in timings:
+        f.write(f'{i},{page},{seconds:.3f}\n')
+    rendertime = sum(seconds for (i, page, seconds) in timings)
+    slowest = max(timings, key=lambda timing: timing[2])
+    print(f'Rendered {len(timings)} pages in {time.time() - t:.1f}s ({rendertime:.1f}s total render time, slowest: page {slowest[1]} with {slowest[2]:.1f}s), timings written to {pagedir}/timings.csv')
+
+  if args.format == 'pdf':
+    mergepdfs(filenames, outfile)
+    print(f'Merged pages into {outfile}')
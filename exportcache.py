@@ -0,0 +1,130 @@
+#!/usr/local/bin/python3
+
+# prepare an atlas export that never touches the database: every PostGIS source (table, geometry column and
+# subset) used by the layers of ZA2.qgs is extracted once -- only the features that intersect the atlas pages
+# of atlas.geojson (plus a margin) -- into its own GeoPackage (with rtree index) in the cache directory, and a
+# copy of the project whose layers read those GeoPackages instead of PostGIS is written to ZA2-export.qgs.
+# features are selected, not cut, so lines and polygons (and their labels) along the page edges stay intact.
+# layers that read the simplified/simplified2 columns get exactly those geometries in their cache.
+# ./exportcache.py atlas.geojson
+# ./export.py Kunming -project ZA2-export.qgs
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+import psycopg2
+
+import qgspatch
+from pageprofile import getsource, getpages
+
+# ogr2ogr layer type of the cache by layer geometry (polygons and lines are all made multi-geometries)
+LAYERTYPES = { 'Point': 'POINT', 'Line': 'MULTILINESTRING', 'Polygon': 'MULTIPOLYGON' }
+
+# returns { (table, geometry column, subset): layer geometry } and { datasource: (table, geometry column, subset) }
+def getsources(data):
+  sources = {}
+  datasources = {}
+  for maplayer in qgspatch.scan(data)['maplayers']:
+    if not 'datasource' in maplayer:
+      continue
+    source = getsource(maplayer['datasource'][2])
+    if source and maplayer['geometry'] in LAYERTYPES:
+      sources[source] = maplayer['geometry']
+      datasources[maplayer['datasource'][2]] = source
+  return (sources, datasources)
+
+# stable name of the cache file of a source, so that reruns overwrite instead of accumulate
+def getcachename(table, geometry, subset):
+  return f'{table.strip("_")}-{geometry}-{hashlib.sha1(subset.encode()).hexdigest()[:8]}'
+
+# the atlas coverage as a (subdivided and indexed) table that all ogr2ogr connections can join against
+def createcoverage(conn, pages, margin):
+  cur = conn.cursor()
+  cur.execute('DROP TABLE IF EXISTS _atlascoverage;')
+  cur.execute("""CREATE UNLOGGED TABLE _atlascoverage AS SELECT ST_Subdivide(ST_Union(ST_Buffer(geography(ST_GeomFromGeoJSON(geojson)), %s)::geometry), 256) AS way
+    FROM unnest(%s::text[]) AS pages(geojson);""", (margin, [ json.dumps(page['geometry']) for page in pages ]))
+  cur.execute('CREATE INDEX ON _atlascoverage USING GIST (way);')
+  cur.execute('ANALYZE _atlascoverage;')
+  conn.commit()
+
+# returns { table: [ non-geometry columns ] }
+def getcolumns(conn, tables):
+  cur = conn.cursor()
+  cur.execute("SELECT table_name, array_agg(column_name::text ORDER BY ordinal_position) FROM information_schema.columns WHERE table_schema = 'public' AND table_name = ANY(%s) AND udt_name NOT IN ('geometry', 'geography') GROUP BY table_name;", (list(tables),))
+  return dict(cur.fetchall())
+
+def extract(connection, filename, name, table, geometry, subset, layertype, columns):
+  geom = f'{geometry}::geometry' if layertype == 'POINT' else f'ST_Multi({geometry}::geometry)'
+  condition = f'({subset}) AND ' if subset else ''
+  sql = f"""SELECT {', '.join(f'"{column}"' for column in columns)}, {geom} AS geom FROM {table} t
+    WHERE {condition}{geometry} IS NOT NULL AND EXISTS (SELECT 1 FROM _atlascoverage c WHERE ST_Intersects(c.way, t.{geometry}::geometry))"""
+  t = time.time()
+  # (write to a temporary file so that an interrupted run never leaves a truncated cache behind)
+  result = subprocess.run(['ogr2ogr', '-f', 'GPKG', '-overwrite', filename + '.tmp', f'PG:{connection}', '-sql', sql,
+    '-nln', name, '-nlt', layertype, '-a_srs', 'EPSG:4326', '-lco', 'SPATIAL_INDEX=YES', '-gt', '65536'], capture_output=True, text=True)
+  if result.returncode != 0:
+    if os.path.exists(filename + '.tmp'):
+      os.remove(filename + '.tmp')
+    return (False, result.stderr.strip())
+  os.replace(filename + '.tmp', filename)
+  return (True, f'{os.path.getsize(filename) / 1e6:.1f}MB in {time.time() - t:.1f}s')
+
+def writecache(geojsonfile, projectfile, outfile, cachedir, margin = 200, jobs = os.cpu_count(), db = 'za', user = 'za', host = 'localhost'):
+  with open(projectfile, 'rb') as f:
+    (sources, datasources) = getsources(f.read())
+  pages = getpages(geojsonfile)
+  print(f'Caching {len(sources)} PostGIS sources of {projectfile} for {len(pages)} atlas pages (+{margin}m)')
+
+  conn = psycopg2.connect(host=host, user=user, database=db)
+  try:
+    createcoverage(conn, pages, margin)
+    columns = getcolumns(conn, set(table for (table, geometry, subset) in sources))
+
+    os.makedirs(cachedir, exist_ok=True)
+    connection = f'dbname={db} user={user} host={host}'
+    # (cache paths are relative to the output project, like the project's own ./atlas.geojson)
+    relativedir = os.path.relpath(cachedir, os.path.dirname(os.path.abspath(outfile)))
+    extracts = []
+    for (source, layergeometry) in sources.items():
+      (table, geometry, subset) = source
+      name = getcachename(table, geometry, subset)
+      if not table in columns:
+        print(f'  {table}.{geometry}: no such table, layers stay on PostGIS')
+        continue
+      extracts.append((source, name, (connection, os.path.join(cachedir, name + '.gpkg'), name, table, geometry, subset, LAYERTYPES[layergeometry], columns[table])))
+
+    # every source is an independent ogr2ogr process with its own database connection
+    cached = {}
+    with ThreadPool(max(1, min(jobs, len(extracts)))) as pool:
+      for ((source, name, job), (success, message)) in zip(extracts, pool.imap(lambda item: extract(*item[2]), extracts)):
+        (table, geometry, subset) = source
+        print(f'  {table}.{geometry}' + (f' [{subset}]' if subset else '') + f': {message}')
+        if success:
+          cached[source] = (f'./{relativedir}/{name}.gpkg|layername={name}', 'ogr')
+
+    conn.cursor().execute('DROP TABLE _atlascoverage;')
+    conn.commit()
+  finally:
+    conn.close()
+
+  qgspatch.patch(projectfile, datasources={ datasource: cached[source] for (datasource, source) in datasources.items() if source in cached }, outfilename=outfile)
+  print(f'{len(cached)} of {len(sources)} sources cached in {cachedir}/, {outfile} reads them instead of PostGIS')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Extract every PostGIS layer source of the QGIS project within the atlas coverage into GeoPackages, and write a copy of the project that renders from them.')
+  parser.add_argument('geojson', nargs='?', default='atlas.geojson', help='atlas geojson file generated by layout.py')
+  parser.add_argument('-project', default='ZA2.qgs', help='QGIS project whose layer sources should be cached')
+  parser.add_argument('-o', default=None, help='output project (default: PROJECT-export.qgs)')
+  parser.add_argument('-cachedir', default='cache', help='directory for the GeoPackages')
+  parser.add_argument('-margin', type=float, default=200, help='also include features up to this many m outside the atlas pages')
+  parser.add_argument('-jobs', type=int, default=os.cpu_count(), help='number of sources extracted in parallel')
+  parser.add_argument('-db', default='za')
+  parser.add_argument('-dbuser', default='za')
+  parser.add_argument('-dbhost', default='localhost')
+  args = parser.parse_args()
+  writecache(args.geojson, args.project, args.o or os.path.splitext(args.project)[0] + '-export.qgs', args.cachedir, args.margin, args.jobs, args.db, args.dbuser, args.dbhost)
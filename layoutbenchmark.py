@@ -0,0 +1,59 @@
+#!/usr/local/bin/python3
+
+# compare layout generation time of the working copy's layout.py against an older git revision, over all atlas files
+# ./layoutbenchmark.py -rev HEAD~1 -n 10
+
+import argparse
+import glob
+import io
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from statistics import median
+
+parser = argparse.ArgumentParser(description='Time layout.py (without -write) for every atlas file, old git revision vs. working copy.')
+parser.add_argument('atlas', nargs='*', default=sorted(glob.glob('data/*.atlas')), help='atlas specification files (default: data/*.atlas)')
+parser.add_argument('-rev', default='HEAD', help='git revision of the old layout.py')
+parser.add_argument('-n', type=int, default=5, help='number of timed runs per atlas (after one warmup run)')
+args = parser.parse_args()
+
+# run a layout.py in-process (so that interpreter startup and imports are only paid once), returns the time in seconds or None if it fails
+def timelayout(script, atlas, outdir):
+  sys.argv = [script, atlas, '-o', os.path.join(outdir, 'atlas.geojson')]
+  # (versions with the .layoutcache/ would otherwise only be timed for cache hits after the warmup run)
+  with open(script) as f:
+    if "'-nocache'" in f.read():
+      sys.argv.append('-nocache')
+  t = time.perf_counter()
+  try:
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+      runpy.run_path(script, run_name='__main__')
+  except Exception:
+    return None
+  return time.perf_counter() - t
+
+with tempfile.TemporaryDirectory() as outdir:
+  oldscript = os.path.join(outdir, 'layout-' + args.rev.replace('/', '_') + '.py')
+  with open(oldscript, 'w') as f:
+    f.write(subprocess.run(['git', 'show', args.rev + ':layout.py'], capture_output=True, text=True, check=True).stdout)
+  scripts = { args.rev: oldscript, 'working copy': 'layout.py' }
+
+  print(f"{'atlas':34} {args.rev:>14} {'working copy':>14} {'speedup':>8}")
+  totals = { name: 0 for name in scripts }
+  for atlas in args.atlas:
+    times = {}
+    for (name, script) in scripts.items():
+      timelayout(script, atlas, outdir)
+      runs = [ timelayout(script, atlas, outdir) for i in range(args.n) ]
+      times[name] = None if None in runs else median(runs)
+    if None in times.values():
+      print(f"{os.path.basename(atlas):34} {'failed':>14}")
+      continue
+    for name in scripts:
+      totals[name] += times[name]
+    print(f"{os.path.basename(atlas):34} {1000 * times[args.rev]:12.1f}ms {1000 * times['working copy']:12.1f}ms {times[args.rev] / times['working copy']:7.2f}x")
+  print(f"{'total':34} {1000 * totals[args.rev]:12.1f}ms {1000 * totals['working copy']:12.1f}ms {totals[args.rev] / totals['working copy']:7.2f}x")
@@ -1,11 +1,8 @@
 #!/usr/local/bin/python3
 
-from xml.etree.ElementTree import fromstring, parse
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from qgspatch import patch
 
-projectdoc = parse('ZA2.qgs')
-masks = projectdoc.findall(".//text-mask")
-for mask in masks:
-  mask.set("maskedSymbolLayers", "")
-
-print('All cleared, writing')
-projectdoc.write('ZA2.qgs')
+print(str(patch('ZA2.qgs', clearmasks=True)) + ' masks cleared')
@@ -0,0 +1,118 @@
+#!/usr/local/bin/python3
+
+# estimate the render cost of every atlas page before exporting: for every PostGIS source (table, geometry
+# column and subset) used by the layers of ZA2.qgs, count the features and vertices that QGIS will have to
+# fetch for each page polygon of atlas.geojson -- all in one set-based query (one LATERAL subquery per source).
+# ./pageprofile.py atlas.geojson
+
+import argparse
+import csv
+import json
+import os
+import re
+import time
+from statistics import median
+from xml.etree.ElementTree import iterparse
+
+import psycopg2
+
+# postgres provider: ... table="public"."_polygon" (simplified) sql=building IS NOT NULL
+POSTGRESSOURCE = re.compile(r'table="(?:\w+)"\."(\w+)" \((\w+)\)(?: sql=(.*))?$', re.DOTALL)
+# ogr provider: PG:dbname='za'|layername=_polygon|subset=boundary IS NOT NULL
+OGRSOURCE = re.compile(r"^PG:.*\|layername=(\w+)(?:\|subset=(.*))?$", re.DOTALL)
+
+# returns (table, geometry column, subset) of a PostGIS layer datasource, None for other layers
+def getsource(datasource):
+  match = POSTGRESSOURCE.search(datasource)
+  if match:
+    return (match.group(1), match.group(2), (match.group(3) or '').strip())
+  match = OGRSOURCE.match(datasource)
+  if match:
+    return (match.group(1), 'way', (match.group(2) or '').strip())
+  return None
+
+# returns { (table, geometry column, subset): [ layer names ] } for all PostGIS layers of a project
+def getsources(projectfile):
+  sources = {}
+  for (event, element) in iterparse(projectfile):
+    if element.tag != 'maplayer':
+      continue
+    source = getsource(element.findtext('datasource') or '')
+    if source:
+      sources.setdefault(source, []).append(element.findtext('layername'))
+    element.clear()
+  return sources
+
+def getpages(geojsonfile):
+  with open(geojsonfile) as f:
+    features = json.load(f)['features']
+  return [ feature for feature in features if feature['properties']['type'] == 'atlaspage' and feature['geometry']['type'] == 'Polygon' ]
+
+# returns one row per page: page number followed by (features, vertices) for every source
+def profile(conn, pages, sources):
+  laterals = []
+  columns = []
+  for (i, (table, geometry, subset)) in enumerate(sources):
+    # (the places view mixes geometry and buffered geography, the cast is a no-op on geometry columns)
+    geometry += '::geometry'
+    condition = f'p.geom && {geometry}' + (f' AND ({subset})' if subset else '')
+    laterals.append(f'CROSS JOIN LATERAL (SELECT COUNT(*) AS n, COALESCE(SUM(ST_NPoints({geometry})), 0) AS v FROM {table} WHERE {condition}) s{i}')
+    columns.append(f's{i}.n, s{i}.v')
+  cur = conn.cursor()
+  cur.execute(f"""SELECT p.page, {', '.join(columns)}
+    FROM (SELECT page, ST_GeomFromGeoJSON(geojson) AS geom FROM unnest(%s::int[], %s::text[]) AS pages(page, geojson)) p
+    {' '.join(laterals)}
+    ORDER BY p.page""", ([ page['properties']['page'] for page in pages ], [ json.dumps(page['geometry']) for page in pages ]))
+  return cur.fetchall()
+
+def writeprofile(geojsonfile, projectfile, outprefix, db = 'za', user = 'za', host = 'localhost'):
+  sources = getsources(projectfile)
+  pages = getpages(geojsonfile)
+  print(f'Profiling {len(pages)} pages against {len(sources)} PostGIS sources used by {sum(map(len, sources.values()))} layers of {projectfile}')
+
+  t = time.time()
+  conn = psycopg2.connect(host=host, user=user, database=db)
+  try:
+    rows = profile(conn, pages, list(sources))
+  finally:
+    conn.close()
+  print(f'Query took {time.time() - t:.1f}s')
+
+  sourcenames = [ f'{table}.{geometry}' + (f' [{subset}]' if subset else '') for (table, geometry, subset) in sources ]
+  totals = { row[0]: (sum(row[1::2]), sum(row[2::2])) for row in rows }
+  typicalvertices = median([ vertices for (features, vertices) in totals.values() ]) or 1
+
+  with open(outprefix + '.csv', 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['page', 'features', 'vertices', 'relativecost'] + [ name + ' ' + count for name in sourcenames for count in ['features', 'vertices'] ])
+    for row in rows:
+      (features, vertices) = totals[row[0]]
+      writer.writerow([row[0], features, vertices, round(vertices / typicalvertices, 2)] + list(row[1:]))
+
+  # heatmap: the page polygons with their cost (style by relativecost in QGIS)
+  bypage = { row[0]: row for row in rows }
+  heatmap = { 'type': 'FeatureCollection', 'features': [] }
+  for page in pages:
+    row = bypage[page['properties']['page']]
+    (features, vertices) = totals[row[0]]
+    properties = { 'page': row[0], 'features': features, 'vertices': vertices, 'relativecost': round(vertices / typicalvertices, 2) }
+    properties.update({ name + ' vertices': row[2 + 2 * i] for (i, name) in enumerate(sourcenames) })
+    heatmap['features'].append({ 'type': 'Feature', 'geometry': page['geometry'], 'properties': properties })
+  with open(outprefix + '.geojson', 'w') as f:
+    json.dump(heatmap, f)
+  print(f'Profile written to {outprefix}.csv and {outprefix}.geojson')
+
+  print('Most expensive pages (vertices relative to the median page):')
+  for (page, (features, vertices)) in sorted(totals.items(), key=lambda item: -item[1][1])[:10]:
+    print(f'  page {page}: {features} features, {vertices} vertices ({vertices / typicalvertices:.1f}x)')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Report per-page feature and vertex counts for every PostGIS source of the QGIS project, to predict slow atlas pages.')
+  parser.add_argument('geojson', nargs='?', default='atlas.geojson', help='atlas geojson file generated by layout.py')
+  parser.add_argument('-project', default='ZA2.qgs', help='QGIS project whose layer sources should be profiled')
+  parser.add_argument('-o', default=None, help='output filename prefix (default: GEOJSON-profile, writes .csv and .geojson)')
+  parser.add_argument('-db', default='za')
+  parser.add_argument('-dbuser', default='za')
+  parser.add_argument('-dbhost', default='localhost')
+  args = parser.parse_args()
+  writeprofile(args.geojson, args.project, args.o or os.path.splitext(args.geojson)[0] + '-profile', args.db, args.dbuser, args.dbhost)
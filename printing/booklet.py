@@ -0,0 +1,122 @@
+#!/usr/local/bin/python3
+
+# booklet imposition in one pass (replaces mutool poster/merge, pdfjam, pdfbook2 and pdftk): every double
+# page of the input pdfs becomes a form xobject which is drawn (clipped to its left or right half, shifted
+# by the binding margin) onto the A4 booklet sheets, so page content and rasters are referenced as they
+# are and never re-encoded. (a page's content stream is reused as the form xobject, and qpdf only copies
+# the stream data from the input file when writing, so even huge rasterized books never have to be decoded or
+# held in memory.)
+# ./booklet.py "Kunming overview.pdf" Kunming.pdf -o Kunming
+# writes Kunming-book.pdf (all sheet sides), Kunming-odd.pdf and Kunming-even-reversed.pdf (for manual duplex printing)
+
+import argparse
+import os
+from contextlib import ExitStack
+
+import pikepdf
+
+MM = 72 / 25.4
+
+parser = argparse.ArgumentParser(description='Split double pages, add a binding margin and impose them as a booklet onto A4 sheets, with separate odd and (reversed) even sides for duplex printing.')
+parser.add_argument('pdf', nargs='+', help='pdf files of double pages (e.g. the overview and the atlas export), concatenated in the given order')
+parser.add_argument('-o', default=None, help='output filename prefix (default: the last input file without .pdf)')
+parser.add_argument('-offset', type=float, default=5, help='binding margin: shift every page this many mm away from the spine (like pdfjam --twoside --offset, which booklet.sh used with .5cm)')
+parser.add_argument('-papersize', type=float, nargs=2, default=(297, 210), metavar=('width', 'height'), help='booklet sheet size in mm (two pages side by side)')
+parser.add_argument('-split', default=False, action='store_true', help='also write the double pages split into single pages (OUTPUT-split.pdf)')
+parser.add_argument('-noempty', default=False, action='store_true', help='do not insert an empty page before the first page')
+
+# copy an object of a source pdf into out (copy_foreign only takes indirect objects, and keeps shared ones shared)
+def copyforeign(out, source, obj):
+  return out.copy_foreign(obj if obj.is_indirect else source.make_indirect(obj))
+
+# the page content as a form xobject in out: if the page has a single content stream, that (copied) stream
+# becomes the form itself, so its data is never decoded but streamed straight from the input file on save
+def getform(out, source, page):
+  if isinstance(page.obj.get('/Contents'), pikepdf.Stream) and '/Resources' in page.obj and int(page.obj.get('/Rotate', 0)) == 0:
+    form = out.copy_foreign(page.obj.Contents)
+    form.Type = pikepdf.Name.XObject
+    form.Subtype = pikepdf.Name.Form
+    form.BBox = [ float(v) for v in page.mediabox ]
+    form.Resources = copyforeign(out, source, page.obj.Resources)
+    return form
+  return out.copy_foreign(page.as_form_xobject())
+
+# returns [ (form xobject in out, x, y, width, height of the half page in form coordinates) or None for an empty page ]
+# (both halves share the same form, pages are processed one at a time)
+def splitpages(out, sources, emptyfront = True):
+  halves = [None] if emptyfront else []
+  for source in sources:
+    for page in source.pages:
+      (x0, y0, x1, y1) = [ float(v) for v in page.mediabox ]
+      form = getform(out, source, page)
+      width = (x1 - x0) / 2
+      halves.append((form, x0, y0, width, y1 - y0))
+      halves.append((form, x0 + width, y0, width, y1 - y0))
+  return halves
+
+# plain split into single pages (like mutool poster -x 2): both halves are copies of the page dictionary that
+# share its contents and resources and only differ in their MediaBox/CropBox
+def writesplit(sources, outfile):
+  with pikepdf.Pdf.new() as out:
+    for source in sources:
+      for page in source.pages:
+        (x0, y0, x1, y1) = [ float(v) for v in page.mediabox ]
+        contents = copyforeign(out, source, page.obj.Contents)
+        resources = copyforeign(out, source, page.obj.Resources)
+        for (left, right) in [(x0, (x0 + x1) / 2), ((x0 + x1) / 2, x1)]:
+          box = [left, y0, right, y1]
+          out.pages.append(pikepdf.Page(pikepdf.Dictionary(Type=pikepdf.Name.Page, MediaBox=box, CropBox=box, Contents=contents, Resources=resources, Rotate=page.obj.get('/Rotate', 0))))
+    out.save(outfile)
+    return len(out.pages)
+
+# sheet sides in printing order (front of sheet 1, back of sheet 1, ...), each side a (left, right) pair of page indices
+def booklet(npages):
+  sides = []
+  for sheet in range(npages // 4):
+    sides.append((npages - 1 - 2 * sheet, 2 * sheet))
+    sides.append((2 * sheet + 1, npages - 2 - 2 * sheet))
+  return sides
+
+def impose(out, halves, papersize, offset):
+  (width, height) = (papersize[0] * MM, papersize[1] * MM)
+  slotwidth = width / 2
+  halves = halves + [None] * (-len(halves) % 4)
+  for (left, right) in booklet(len(halves)):
+    resources = pikepdf.Dictionary()
+    content = []
+    for (slot, i) in enumerate([left, right]):
+      if halves[i] == None:
+        continue
+      (form, x0, y0, w, h) = halves[i]
+      # right-hand (odd) pages move right, left-hand (even) pages move left
+      x = slot * slotwidth + (slotwidth - w) / 2 + (offset if i % 2 == 0 else -offset) * MM
+      y = (height - h) / 2
+      name = f'/P{slot}'
+      resources[name] = form
+      content.append(f'q {x:.4f} {y:.4f} {w:.4f} {h:.4f} re W n 1 0 0 1 {x - x0:.4f} {y - y0:.4f} cm {name} Do Q')
+    page = pikepdf.Dictionary(Type=pikepdf.Name.Page, MediaBox=[0, 0, width, height],
+      Resources=pikepdf.Dictionary(XObject=resources), Contents=out.make_stream(' '.join(content).encode()))
+    out.pages.append(pikepdf.Page(page))
+
+def writebooklet(infiles, outprefix, offset = 5, papersize = (297, 210), emptyfront = True, split = False):
+  # (the input pdfs have to stay open until all outputs are saved)
+  with ExitStack() as stack:
+    sources = [ stack.enter_context(pikepdf.open(filename)) for filename in infiles ]
+    if split:
+      print(f'{writesplit(sources, outprefix + "-split.pdf")} single pages: {outprefix}-split.pdf')
+    book = stack.enter_context(pikepdf.Pdf.new())
+    halves = splitpages(book, sources, emptyfront)
+    impose(book, halves, papersize, offset)
+    book.save(outprefix + '-book.pdf')
+    print(f'{len(halves)} pages imposed onto {len(book.pages) // 2} sheets: {outprefix}-book.pdf')
+
+    # for manual duplex printing: print all fronts, then turn the stack and print the backs in reverse order
+    for (suffix, sides) in [('-odd', book.pages[0::2]), ('-even-reversed', book.pages[1::2][::-1])]:
+      with pikepdf.Pdf.new() as pdf:
+        pdf.pages.extend(sides)
+        pdf.save(outprefix + suffix + '.pdf')
+      print(f'{len(sides)} sheet sides: {outprefix}{suffix}.pdf')
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  writebooklet(args.pdf, args.o or os.path.splitext(args.pdf[-1])[0], args.offset, args.papersize, not args.noempty, args.split)
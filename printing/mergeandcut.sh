@@ -1,5 +1,4 @@
 #!/bin/sh
-echo "Merging preface and atlas map pages into one file..."
-mutool merge -o "$1-merged.pdf" "$1 overview.pdf" "$1.pdf"
-# should only be called with files in the PARENT directory, because booklet.sh will overwrite stuff
-./booklet.sh "$1-merged.pdf"
+echo "Imposing preface and atlas map pages as a booklet..."
+# should only be called with files in the PARENT directory, because booklet.py will overwrite stuff
+"`dirname "$0"`/booklet.py" -offset 5 "$1 overview.pdf" "$1.pdf" -o "$1"
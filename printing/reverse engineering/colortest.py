@@ -39,9 +39,12 @@ from colour import Color # for parsing
 #from colormath.color_conversions import convert_color
 
 import os
+import zlib
 from decimal import Decimal
 from math import floor
 
+import numpy as np
+
 class ColorAction(argparse.Action):
   def __call__(self, parser, namespace, values, option_string=None):
 #    if len(values) % 3 == 0:
@@ -81,47 +84,47 @@ parser.add_argument('colors', nargs='+', action=ColorAction, help='color specifi
 
 args = parser.parse_args()
 #colors = [convert_color(args.inspace(*col.rgb), args.diffspace) for col in args.colors] # FIXME only works for sRGBColor inspace right now!
-colors = args.colors
+# base colors as an (ncolors, 3) array of hsl values (as parsed by colour)
+colors = np.array([col.hsl for col in args.colors])
 args.d = [d / 255 for d in args.d]
 
-def swapvalue(lst, i, newvalue):
-  lst[i] = newvalue
-  return lst
-
+# vectorized conversions, all on arrays of shape (..., 3)
 def hsltohsv(hsl):
-  v = hsl[2] + hsl[1] * min(hsl[2], 1-hsl[2])
-  return [hsl[0], 0 if v == 0 else 2 * (1 - hsl[2] / v), v]
+  (h, s, l) = np.moveaxis(hsl, -1, 0)
+  v = l + s * np.minimum(l, 1-l)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.stack([h, np.where(v == 0, 0, 2 * (1 - l / v)), v], axis=-1)
 
 def hsvtohsl(hsv):
-  l = hsv[2] * (1 - hsv[1] / 2)
-  return [hsv[0], 0 if (l == 0 or l == 1) else (hsv[2] - l) / min(l, 1-l), l]
-
-# generate neighbouring colors
-def gethsvneighbours(col, dim):
-  n = 1 + 2 * args.n[dim]
-  col = hsltohsv(col.hsl)
-  if dim == 0:
-    # allow overrun of hue
-    mn = col[dim] - args.n[dim] * args.d[dim]
-  else:
-    mn = max(0, min(col[dim] - args.n[dim] * args.d[dim], 1 - (n-1) * args.d[dim]))
-  # this works, but it loses the computed hsvg values again by converting into hsl...
-  return [Color(hsl=hsvtohsl(swapvalue(list(col), dim, mn + i * args.d[dim]))) for i in range(n)]
-
-def gethslneighbours(col, dim):
+  (h, s, v) = np.moveaxis(hsv, -1, 0)
+  l = v * (1 - s / 2)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.stack([h, np.where((l == 0) | (l == 1), 0, (v - l) / np.minimum(l, 1-l)), l], axis=-1)
+
+# same results as colour.hsl2rgb() (hue wraps around, no saturation = gray)
+def hsltorgb(hsl):
+  (h, s, l) = np.moveaxis(hsl, -1, 0)
+  v2 = np.where(l < 0.5, l * (1.0 + s), (l + s) - (s * l))
+  v1 = 2.0 * l - v2
+  def huetorgb(vh):
+    vh = np.mod(vh, 1)
+    return np.select([6 * vh < 1, 2 * vh < 1, 3 * vh < 2], [v1 + (v2 - v1) * 6 * vh, v2, v1 + (v2 - v1) * ((2.0 / 3) - vh) * 6], v1)
+  rgb = np.stack([huetorgb(h + (1.0 / 3)), huetorgb(h), huetorgb(h - (1.0 / 3))], axis=-1)
+  return np.where((s == 0)[..., None], l[..., None], rgb)
+
+# generate neighbouring colors: (..., 3) hsl -> (..., 1+2n, 3) hsl
+def getneighbours(hsl, dim):
   n = 1 + 2 * args.n[dim]
-  # make editable (tuples are immutable!)
-#  colt = list(col.get_value_tuple())
-  # colt[dim] - args.n[dim] * args.d[dim], but clamped to [0, 1 - (n-1) * args.d[dim]]
+  col = hsltohsv(hsl) if args.hsv else hsl
   if dim == 0:
     # allow overrun of hue
-    mn = col.hsl[dim] - args.n[dim] * args.d[dim]
+    mn = col[..., dim] - args.n[dim] * args.d[dim]
   else:
-    mn = max(0, min(col.hsl[dim] - args.n[dim] * args.d[dim], 1 - (n-1) * args.d[dim]))
-  return [Color(hsl=swapvalue(list(col.hsl), dim, mn + i * args.d[dim])) for i in range(n)]
-#  return [args.diffspace(*swapvalue(colt, dim, i*args.d[dim])) for i in range(n)]
-
-getneighbours = gethsvneighbours if args.hsv else gethslneighbours
+    mn = np.maximum(0, np.minimum(col[..., dim] - args.n[dim] * args.d[dim], 1 - (n-1) * args.d[dim]))
+  neighbours = np.repeat(col[..., None, :], n, axis=-2)
+  neighbours[..., dim] = mn[..., None] + np.arange(n) * args.d[dim]
+  # (in hsv this loses the computed hsv values again by converting into hsl, like the colour objects did)
+  return hsvtohsl(neighbours) if args.hsv else neighbours
 
 # calculate neighbours in the 'diffspace'
 # 1st dim is top-down next to each other boxes (saturation)
@@ -129,22 +132,23 @@ getneighbours = gethsvneighbours if args.hsv else gethslneighbours
 # 3rd dim is left-right next to each other boxes (lightness)
 dimorder = (1, 0, 2)
 
-d1neighbours = [getneighbours(col, dimorder[0]) for col in colors]
-d2neighbours = [[getneighbours(col, dimorder[1]) for col in sublist] for sublist in d1neighbours]
-d3neighbours = [[[getneighbours(col, dimorder[2]) for col in sublist] for sublist in mainlist] for mainlist in d2neighbours]
+# (ncolors, n1, n2, n3, 3) hsl values
+neighbours = getneighbours(getneighbours(getneighbours(colors, dimorder[0]), dimorder[1]), dimorder[2])
+(ncolors, n1, n2, n3) = neighbours.shape[:4]
 
-# boxes along the x axis = 1st dimension * (2nd dimension + 1 for spacing) - 1
-nx = (len(d3neighbours[0][0]) + 1) * len(d3neighbours[0][0][0]) - 1
+# boxes along the x axis = 2nd dimension groups * (3rd dimension boxes + 1 for spacing) - 1
+# (the PostScript version computed (n2 + 1) * n3 - 1, which is only the same when n2 == n3)
+nx = (n3 + 1) * n2 - 1
 # boxes along the y axis = ncolors * (3rd dimension + 1 for spacing) - 1
-ny = (len(d3neighbours[0]) + 1) * len(colors) - 1
+ny = (n1 + 1) * ncolors - 1
 
 # all in pt
 size = papersize.parse_papersize(args.paper)
 if args.landscape:
   size = papersize.rotate(size, papersize.LANDSCAPE)
-margin = papersize.parse_length(args.margin)
+margin = float(papersize.parse_length(args.margin))
 
-printsize = [s - 2*margin for s in size]
+printsize = [float(s) - 2*margin for s in size]
 boxwidth = printsize[0] / nx
 boxheight = printsize[1] / ny
 print(f'{nx}x{ny} fits {boxwidth}x{boxheight}')
@@ -152,64 +156,52 @@ print(f'{nx}x{ny} fits {boxwidth}x{boxheight}')
 boxwidth = min(boxwidth, boxheight)
 boxheight = min(boxwidth, boxheight)
 print('box size: ' + str(boxheight/3) + ' mm')
-#boxsize = min(boxwidth, boxheight)
-
-# parse rectangle/square specs
-#def parserectanglespec(spec):
-#  try:
-#    return papersize.parse_papersize(spec)
-#  except:
-#    length = papersize.parse_length(spec)
-#    return [length, length]
-
-#args.rectangle = [parserectanglespec(re) for re in args.rectangle]
-
-# def parsecolor(spec):
-#   try:
-#     spec = webcolors.name_to_hex(spec)
-#   except:
-#     pass
-#   return sRGBColor.new_from_rgb_hex(spec)
 
-# colors = { col: parsecolor(col) for col in args.color }
-
-def drawbox(col, xoffset, yoffset):
-  return ' '.join(str(x) for x in col.rgb) + ' setrgbcolor ' + str(margin + xoffset * boxwidth) + ' ' + str(margin + yoffset * boxheight) + ' ' + str(boxwidth)+ ' ' + str(boxheight) + ' rectfill '
+# box positions: colors go bottom-up (with a blank line each), saturation rows bottom-up,
+# hue groups left-right (with a blank column each), lightness/value boxes left-right
+(c, i, j, k) = np.indices(neighbours.shape[:4])
+boxes = np.column_stack([hsltorgb(neighbours).reshape(-1, 3), margin + (j * (n3 + 1) + k).reshape(-1) * boxwidth, margin + (c * (n1 + 1) + i).reshape(-1) * boxheight])
 
 def drawlabel(text, xoffset, yoffset):
-  return ' 0 setgray ' + str(margin + xoffset * boxwidth + 12) + ' ' + str(margin + yoffset * boxheight + 5) + ' moveto (' + str(round(255*text)) + ') show '
-
-postscript = '/Times 10 selectfont '
-x = 0
-y = 0
-for color in d3neighbours:
-  for d3 in color:
-    # this one goes top-down
-    # reset horizontal axis
-    x = 0
-    for d2 in d3:
-      # left right (tight)
-#      print(d2[0].hsl[dimorder[1]])
-      for d1 in d2:
-        # left right (groups)
-#        print(d1.hsl[dimorder[2]])
-        postscript += drawbox(d1, x, y)
-        x = x+1
-        # add blank column
-      x = x+1
-    # write saturation levels (td)
-    postscript += drawlabel((hsltohsv(d3[0][0].hsl)[1] if args.hsv else d3[0][0].hsl[dimorder[0]])*100/255, -1, y)
-    y = y+1
-  # hue *extremes* only (lr-boxes)
-  postscript += drawlabel(d3[0][0].hsl[dimorder[1]]*360/255, args.n[dimorder[1]], y)
-  postscript += drawlabel(d3[4][0].hsl[dimorder[1]]*360/255, args.n[dimorder[1]] + 2*args.n[dimorder[2]]*(2+2*args.n[dimorder[1]]), y)
+  return f'BT {margin + xoffset * boxwidth + 12:.4f} {margin + yoffset * boxheight + 5:.4f} Td ({round(255*text)}) Tj ET'
+
+content = [ f'{r:.6f} {g:.6f} {b:.6f} rg {x:.4f} {y:.4f} {boxwidth:.4f} {boxheight:.4f} re f' for (r, g, b, x, y) in boxes.tolist() ]
+content.append('0 g /F1 10 Tf')
+hsvs = hsltohsv(neighbours)
+for color in range(ncolors):
+  y = color * (n1 + 1)
+  # write saturation levels (td)
+  for row in range(n1):
+    content.append(drawlabel((hsvs[color, row, 0, 0, 1] if args.hsv else neighbours[color, row, 0, 0, dimorder[0]])*100/255, -1, y + row))
+  # hue *extremes* only (lr-boxes), of the last saturation row
+  last = neighbours[color, -1]
+  content.append(drawlabel(last[0, 0, dimorder[1]]*360/255, args.n[dimorder[1]], y + n1))
+  content.append(drawlabel(last[-1, 0, dimorder[1]]*360/255, args.n[dimorder[1]] + 2*args.n[dimorder[2]]*(2+2*args.n[dimorder[1]]), y + n1))
   # value *extremes* only (lr)
-  mn = hsltohsv(d3[0][0].hsl)[2] if args.hsv else d3[0][0].hsl[dimorder[2]]
-  mx = hsltohsv(d3[0][2 * args.n[2]].hsl)[2] if args.hsv else d3[0][2 * args.n[2]].hsl[dimorder[2]]
-  postscript += drawlabel(mn*100/255, args.n[dimorder[2]] + args.n[dimorder[2]]*(2+2*args.n[dimorder[1]]) - 2, y)
-  postscript += drawlabel(mx*100/255, args.n[dimorder[2]] + args.n[dimorder[2]]*(2+2*args.n[dimorder[1]]) + 2, y)
-  # add blank line
-  y = y+1
+  mn = hsvs[color, -1, 0, 0, 2] if args.hsv else last[0, 0, dimorder[2]]
+  mx = hsvs[color, -1, 0, 2 * args.n[2], 2] if args.hsv else last[0, 2 * args.n[2], dimorder[2]]
+  content.append(drawlabel(mn*100/255, args.n[dimorder[2]] + args.n[dimorder[2]]*(2+2*args.n[dimorder[1]]) - 2, y + n1))
+  content.append(drawlabel(mx*100/255, args.n[dimorder[2]] + args.n[dimorder[2]]*(2+2*args.n[dimorder[1]]) + 2, y + n1))
+
+# write a minimal single-page pdf straight away (no ghostscript, no command line size limits)
+def writepdf(filename, width, height, content):
+  stream = zlib.compress('\n'.join(content).encode())
+  objects = [
+    b'<< /Type /Catalog /Pages 2 0 R >>',
+    b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+    f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] /Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>'.encode(),
+    b'<< /Type /Font /Subtype /Type1 /BaseFont /Times-Roman >>',
+    f'<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n'.encode() + stream + b'\nendstream' ]
+  with open(filename, 'wb') as f:
+    f.write(b'%PDF-1.4\n')
+    offsets = []
+    for (i, obj) in enumerate(objects):
+      offsets.append(f.tell())
+      f.write(f'{i + 1} 0 obj\n'.encode() + obj + b'\nendobj\n')
+    xref = f.tell()
+    f.write(f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode())
+    f.write(''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode())
+    f.write(f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
 
 #for colname, rgb in colors.items():
 #  for (x,y) in args.rectangle:
@@ -240,14 +232,7 @@ def isnamedsize(spec):
     papersize.parse_papersize(spec)
     return True
 
-#if isnamedsize(args.paper):
-#  gsspec = '-sPAPERSIZE=' + args.paper
-#else:
-gsspec = '-dDEVICEWIDTHPOINTS=' + str(round(size[0])) + ' -dDEVICEHEIGHTPOINTS=' + str(round(size[1]))
-
-#print(postscript)
-
-os.system('gs -q ' + gsspec + ' -dBATCH -dNOPAUSE -sDEVICE=pdfwrite -sOutputFile=' + args.outfile + ' -c "' + postscript + '"')
+writepdf(args.outfile, round(size[0]), round(size[1]), content)
 
 # if args.nup:
 #   # calculate fit
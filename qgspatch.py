@@ -0,0 +1,152 @@
+#!/usr/local/bin/python3
+
+# patch a QGIS project file without building (and re-serializing) an ElementTree: a streaming expat pass
+# finds the byte offsets of the top-level <Layouts>, its <Layout name=...> children, all text-masks and
+# the <datasource>/<provider> of every <maplayer>, then only those byte ranges are replaced and everything
+# else is copied through as raw bytes. (the offsets of all top-level elements and of the start tag and
+# children of every <maplayer> are also returned, e.g. for hashing parts of the project)
+
+import mmap
+import os
+import re
+import xml.parsers.expat
+from xml.sax.saxutils import escape
+
+MASKEDSYMBOLLAYERS = re.compile(rb'''maskedSymbolLayers=("[^"]*"|'[^']*')''')
+
+# a start tag (attribute values may contain '>'), group 1 is '/' for self-closing elements
+STARTTAG = re.compile(rb'''<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*(/?)>''')
+
+def isempty(data, index):
+  match = STARTTAG.match(data, index)
+  return match != None and match.group(1) == b'/'
+
+def gettagend(data, index):
+  match = STARTTAG.match(data, index)
+  return match.end() if match != None else data.find(b'>', index) + 1
+
+def getelementend(data, index, empty):
+  # expat reports end tags at their '<', self-closing elements right after their '/>' (which can be directly
+  # followed by the parent's end tag, so whether the element was self-closing is taken from its start tag)
+  return index if empty else data.find(b'>', index) + 1
+
+def scan(data):
+  # maplayers: [ { 'geometry': geometry attribute, 'datasource': (start, end, text), 'provider': (start, end, text),
+  #   'id': (start, end, text), 'tag': (start, end) of the start tag, 'children': [ (name, start, end) ] } ]
+  # elements: { name: (start, end) } of the top-level elements
+  offsets = {'layouts': None, 'layout': {}, 'masks': [], 'maplayers': [], 'elements': {}}
+  parser = xml.parsers.expat.ParserCreate()
+  depth = 0
+  current = {}
+  # whether each currently open element is self-closing
+  empty = []
+
+  def start(name, attrs):
+    nonlocal depth
+    depth += 1
+    empty.append(isempty(data, parser.CurrentByteIndex))
+    if depth == 2:
+      current['element'] = parser.CurrentByteIndex
+    elif 'maplayer' in current and depth == current['maplayer']['depth'] + 1:
+      current['child'] = parser.CurrentByteIndex
+    if depth == 2 and name == 'Layouts':
+      current['layouts'] = parser.CurrentByteIndex
+    elif depth == 3 and name == 'Layout' and 'layouts' in current:
+      current['layout'] = (attrs.get('name'), parser.CurrentByteIndex)
+    elif name == 'text-mask':
+      offsets['masks'].append(parser.CurrentByteIndex)
+    elif name == 'maplayer':
+      current['maplayer'] = {'geometry': attrs.get('geometry'), 'depth': depth, 'tag': (parser.CurrentByteIndex, gettagend(data, parser.CurrentByteIndex)), 'children': []}
+    elif name in ['datasource', 'provider', 'id'] and 'maplayer' in current and depth == current['maplayer']['depth'] + 1:
+      current['text'] = (name, parser.CurrentByteIndex, [])
+
+  def characters(text):
+    if 'text' in current:
+      current['text'][2].append(text)
+
+  def end(name):
+    nonlocal depth
+    elementend = getelementend(data, parser.CurrentByteIndex, empty.pop())
+    if depth == 2:
+      offsets['elements'][name] = (current.pop('element'), elementend)
+    elif 'maplayer' in current and depth == current['maplayer']['depth'] + 1:
+      current['maplayer']['children'].append((name, current.pop('child'), elementend))
+    if depth == 2 and name == 'Layouts' and 'layouts' in current:
+      offsets['layouts'] = (current.pop('layouts'), elementend)
+    elif depth == 3 and name == 'Layout' and 'layout' in current:
+      (layoutname, layoutstart) = current.pop('layout')
+      offsets['layout'][layoutname] = (layoutstart, elementend)
+    elif name == 'maplayer' and 'maplayer' in current:
+      maplayer = current.pop('maplayer')
+      del maplayer['depth']
+      offsets['maplayers'].append(maplayer)
+    elif 'text' in current and name == current['text'][0]:
+      (element, start, text) = current.pop('text')
+      current['maplayer'][element] = (start, elementend, ''.join(text))
+    depth -= 1
+
+  parser.StartElementHandler = start
+  parser.EndElementHandler = end
+  parser.CharacterDataHandler = characters
+  chunksize = 1 << 20
+  for i in range(0, len(data), chunksize):
+    parser.Parse(data[i:i+chunksize], i + chunksize >= len(data))
+  return offsets
+
+# layouts: { name: xml text of the new <Layout> element } (replacing any existing layout of that name in place, appending otherwise)
+# clearmasks: blank all maskedSymbolLayers attributes of text-masks
+# datasources: { old datasource: (new datasource, new provider) } for maplayers to switch to another data source
+# outfilename: write the patched project to this file instead of replacing the original
+def patch(filename, layouts = {}, clearmasks = False, datasources = {}, outfilename = None):
+  with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    offsets = scan(data)
+    # (start, end, replacement) byte ranges
+    edits = []
+
+    appended = b''
+    for (name, layout) in layouts.items():
+      if name in offsets['layout']:
+        (start, end) = offsets['layout'][name]
+        edits.append((start, end, layout.encode()))
+      else:
+        appended += layout.encode()
+    if appended:
+      if offsets['layouts'] == None:
+        raise ValueError(f'{filename} has no top-level <Layouts> element')
+      (start, end) = offsets['layouts']
+      if data[end-2:end] == b'/>':
+        edits.append((start, end, b'<Layouts>' + appended + b'</Layouts>'))
+      else:
+        closingtag = data.rfind(b'</', start, end)
+        edits.append((closingtag, closingtag, appended))
+
+    if clearmasks:
+      for start in offsets['masks']:
+        match = MASKEDSYMBOLLAYERS.search(data, start, data.find(b'>', start))
+        if match and match.end() - match.start() > len('maskedSymbolLayers=""'):
+          edits.append((match.start(), match.end(), b'maskedSymbolLayers=""'))
+
+    for maplayer in offsets['maplayers']:
+      if 'datasource' in maplayer and maplayer['datasource'][2] in datasources:
+        (datasource, provider) = datasources[maplayer['datasource'][2]]
+        (start, end, text) = maplayer['datasource']
+        edits.append((start, end, f'<datasource>{escape(datasource)}</datasource>'.encode()))
+        if 'provider' in maplayer:
+          (start, end, text) = maplayer['provider']
+          # (keep the provider element's attributes)
+          tagend = data.find(b'>', start) + 1
+          edits.append((start, end, data[start:tagend] + f'{escape(provider)}</provider>'.encode()))
+
+    # stream unchanged bytes straight from the map into a temporary file, then swap it in
+    edits.sort(key=lambda edit: edit[0])
+    outfilename = outfilename or filename
+    tmpfilename = outfilename + '.tmp'
+    with open(tmpfilename, 'wb') as out:
+      position = 0
+      for (start, end, replacement) in edits:
+        out.write(data[position:start])
+        out.write(replacement)
+        position = end
+      out.write(data[position:])
+  os.replace(tmpfilename, outfilename)
+  return len(edits)
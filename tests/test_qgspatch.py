@@ -0,0 +1,40 @@
+import os
+import sys
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import qgspatch
+
+def writeproject(tmp_path, xml):
+  filename = str(tmp_path / 'project.qgs')
+  with open(filename, 'wb') as f:
+    f.write(xml)
+  return filename
+
+def test_replace_selfclosing_last_layout(tmp_path):
+  filename = writeproject(tmp_path, b'<qgis><Layouts><Layout name="A"><x/></Layout><Layout name="B"/></Layouts></qgis>')
+  qgspatch.patch(filename, layouts={'B': '<Layout name="B"><y/></Layout>'})
+  with open(filename, 'rb') as f:
+    assert f.read() == b'<qgis><Layouts><Layout name="A"><x/></Layout><Layout name="B"><y/></Layout></Layouts></qgis>'
+
+def test_append_after_selfclosing_layout(tmp_path):
+  filename = writeproject(tmp_path, b'<qgis><Layouts><Layout name="A" title="a/>b"/></Layouts></qgis>')
+  qgspatch.patch(filename, layouts={'C': '<Layout name="C"/>'})
+  root = ElementTree.parse(filename).getroot()
+  assert [ layout.get('name') for layout in root.find('Layouts') ] == ['A', 'C']
+
+def test_selfclosing_datasource(tmp_path):
+  filename = writeproject(tmp_path, b'<qgis><projectlayers><maplayer geometry="Point"><datasource/><provider encoding="">postgres</provider></maplayer></projectlayers></qgis>')
+  qgspatch.patch(filename, datasources={'': ('./cache/x.gpkg|layername=x', 'ogr')})
+  maplayer = ElementTree.parse(filename).getroot().find('projectlayers/maplayer')
+  assert maplayer.findtext('datasource') == './cache/x.gpkg|layername=x'
+  assert maplayer.findtext('provider') == 'ogr'
+
+def test_maplayer_children_and_elements():
+  data = b'<qgis><mapcanvas><extent/></mapcanvas><projectlayers><maplayer geometry="Line"><id>a</id><renderer-v2 type="x"><id>nested</id></renderer-v2><labeling/></maplayer></projectlayers></qgis>'
+  offsets = qgspatch.scan(data)
+  assert [ data[start:end] for (start, end) in offsets['elements'].values() ] == [b'<mapcanvas><extent/></mapcanvas>', data[data.find(b'<projectlayers>'):data.find(b'</qgis>')]]
+  (maplayer,) = offsets['maplayers']
+  assert maplayer['id'][2] == 'a'
+  assert data[maplayer['tag'][0]:maplayer['tag'][1]] == b'<maplayer geometry="Line">'
+  assert [ (name, data[start:end]) for (name, start, end) in maplayer['children'] ] == [('id', b'<id>a</id>'), ('renderer-v2', b'<renderer-v2 type="x"><id>nested</id></renderer-v2>'), ('labeling', b'<labeling/>')]